@@ -5,16 +5,29 @@ import AutoAwesomeIcon from '@mui/icons-material/AutoAwesome';
 import MapIcon from '@mui/icons-material/Map';
 import { LuLineChart } from "react-icons/lu";
 import { IoBarChartSharp } from "react-icons/io5";
+import { MdSensors } from "react-icons/md";
 import axios from 'axios';
 import { motion } from 'framer-motion';
 
+// points kept per line while live tailing, older ones roll off the left
+const LIVE_ROLLOVER = 5000;
+
+// arrays from the server come in Bokeh's ndarray format: little endian bytes, base64 encoded
+const decodeArray = ({ array, dtype }) => {
+    const bytes = Uint8Array.from(atob(array.data), (c) => c.charCodeAt(0));
+    return dtype === 'int64' ? new BigInt64Array(bytes.buffer) : new Float64Array(bytes.buffer);
+};
+
 const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAskAI }) => {
     const [fullPlotData, setFullPlotData] = useState(null);
     const [filteredPlotData, setFilteredPlotData] = useState(null);
     const [showAlert, setShowAlert] = useState(false);
     const [showMap, setShowMap] = useState(false);
     const [isFilteredDataEmpty, setIsFilteredDataEmpty] = useState(false);
+    const [plotType, setPlotType] = useState(null);
+    const [isLive, setIsLive] = useState(false);
     const plotContainerRef = useRef(null);
+    const fullPlotViewsRef = useRef(null);
 
     const fetchPlotData = async (cacheKey, plotType, columns) => {
         console.log(cacheKey, plotType, columns.toString());
@@ -62,6 +75,8 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
         }
         setShowAlert(false);
         setShowMap(false); // Ensure map is hidden when fetching plot data
+        setIsLive(false);
+        setPlotType(plotType);
         fetchPlotData(cacheKey, plotType, selectedColumns);
         onAskAI(false); // Reset the aiAsked state when Line or Bar button is clicked
     };
@@ -72,6 +87,7 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
         const lon = 'long'; 
         fetchMapData(cacheKey, lat, lon);
         setShowMap(true);
+        setIsLive(false);
         // Clear plots and AI state when Map is clicked
         setFullPlotData(null);
         setFilteredPlotData(null);
@@ -85,6 +101,7 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
         setShowAlert(false);
         // Ensure map and plots are hidden when Ask AI is clicked
         setShowMap(false);
+        setIsLive(false);
         setFullPlotData(null);
         setFilteredPlotData(null);
         setIsFilteredDataEmpty(false);
@@ -95,7 +112,9 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
             const fullPlotDiv = document.getElementById("bokeh-plot-full");
             if (fullPlotDiv) {
                 fullPlotDiv.innerHTML = "";
-                embed.embed_item(fullPlotData, "bokeh-plot-full");
+                embed.embed_item(fullPlotData, "bokeh-plot-full").then((views) => {
+                    fullPlotViewsRef.current = views;
+                });
             }
         }
         if (filteredPlotData && typeof document !== 'undefined' && !isFilteredDataEmpty) {
@@ -111,8 +130,38 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
         }
     }, [fullPlotData, filteredPlotData, isFilteredDataEmpty]);
 
+    useEffect(() => {
+        if (!isLive) {
+            return;
+        }
+        // new rows are appended to the full data line plot, each line is named after its column
+        const params = new URLSearchParams({ cache_key: cacheKey, columns: selectedColumns.toString() });
+        const socket = new WebSocket(`ws://localhost:8001/live?${params}`);
+        socket.onmessage = (event) => {
+            const rows = JSON.parse(event.data);
+            const views = fullPlotViewsRef.current;
+            const doc = views && views.roots.length > 0 ? views.roots[0].model.document : null;
+            if (!doc) {
+                return;
+            }
+            selectedColumns.forEach((column) => {
+                const renderer = doc.get_model_by_name(column);
+                if (renderer && rows[column]) {
+                    renderer.data_source.stream({ x: decodeArray(rows.timestamp), y: decodeArray(rows[column]) }, LIVE_ROLLOVER);
+                }
+            });
+        };
+        socket.onerror = (error) => {
+            console.error('Live tail error:', error);
+        };
+        socket.onclose = () => setIsLive(false);
+
+        return () => socket.close();
+    }, [isLive, cacheKey, selectedColumns]);
+
     useEffect(() => {
         if (clearPlot) {
+            setIsLive(false);
             setFullPlotData(null);
             setFilteredPlotData(null);
             setIsFilteredDataEmpty(false);
@@ -176,6 +225,25 @@ const PlotViewer = ({ cacheKey, selectedColumns, clearPlot, onPlotsCleared, onAs
                     >
                         Bar
                     </Button>
+                    <Button
+                        size="sm"
+                        variant="solid"
+                        bg={isLive ? "red.500" : "green.500"}
+                        color="white"
+                        boxShadow="0px 8px 6px -1px rgba(0, 0, 0, 0.1)"
+                        _hover={{ bg: isLive ? "red.400" : "green.400" }}
+                        _active={{
+                            bg: isLive ? "red.500" : "green.500",
+                            boxShadow: "none"
+                        }}
+                        width="100px"
+                        marginLeft="10px"
+                        isDisabled={plotType !== 'line' || !fullPlotData}
+                        onClick={() => setIsLive(!isLive)}
+                        leftIcon={<MdSensors size="1.5em" color="white" />}
+                    >
+                        {isLive ? "Stop" : "Live"}
+                    </Button>
                     <Button
                         size="sm"
                         variant="solid"
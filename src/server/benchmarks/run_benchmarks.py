@@ -0,0 +1,171 @@
+"""
+Benchmarks for the server hot paths on synthetic IMU-like data.
+
+    cd src/server
+    python benchmarks/run_benchmarks.py --sizes 10k,100k,1M --output results.json
+    python benchmarks/run_benchmarks.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+
+Every case is timed (best of --repeat runs) and its peak traced allocation is recorded.
+With --compare, cases slower or larger than the baseline by more than --tolerance are
+reported and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_redis import encode_frame, decode_frame
+from filter import DataFilter
+from plot import BokehPlotter
+from map import FoliumPlotter
+
+
+def make_imu_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """100 Hz IMU trace with occasional spikes and a GPS random walk."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2024-01-01").value
+    df = pd.DataFrame({
+        "timestamp": start + np.arange(rows, dtype=np.int64) * 10_000_000,
+        "x": rng.normal(0, 1, rows),
+        "y": rng.normal(0, 1, rows),
+        "z": rng.normal(9.81, 0.5, rows),
+        "lat": 37.5 + np.cumsum(rng.normal(0, 1e-5, rows)),
+        "long": 127.0 + np.cumsum(rng.normal(0, 1e-5, rows)),
+    })
+    spikes = rng.choice(rows, size=max(rows // 1000, 1), replace=False)
+    df.loc[spikes, "x"] *= 20
+    return df
+
+
+def filter_case(selected_filter="", input_value="", **checkboxes):
+    def run(df):
+        return DataFilter(df, selected_filter, input_value, checkboxes, "x").apply_filter()
+    return run
+
+
+def json_round_trip(df):
+    return pd.DataFrame(json.loads(df.to_json(orient="records")))
+
+
+def frame_round_trip(df):
+    return decode_frame(encode_frame(df))
+
+
+# name -> (callable, largest row count the case is run for)
+CASES = {
+    "filter.numeric": (filter_case(">", "0.5"), None),
+    "filter.iqr": (filter_case(iqr=True), None),
+    "filter.moving_average": (filter_case(movingAvg=True), None),
+    "filter.gaussian": (filter_case(gaussian=True), None),
+    "filter.chain": (filter_case(">", "-3", iqr=True, movingAvg=True, gaussian=True), None),
+    "plot.line": (lambda df: BokehPlotter(df, "line", "x,y,z", "Full Data").line_plot(), 1_000_000),
+    "plot.bar": (lambda df: BokehPlotter(df, "bar", "x,y,z", "Full Data").bar_plot(), 10_000_000),
+    "map.heatmap": (lambda df: FoliumPlotter(df, "lat", "long").heatmap_plot(), 100_000),
+    "cache.json_round_trip": (json_round_trip, 1_000_000),
+    "cache.frame_round_trip": (frame_round_trip, None),
+}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+
+def measure(fn, df, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(df)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1024 ** 2
+
+
+def run(sizes, cases, repeat: int):
+    results = []
+    for rows in sizes:
+        df = make_imu_frame(rows)
+        for name in cases:
+            fn, max_rows = CASES[name]
+            if max_rows is not None and rows > max_rows:
+                continue
+            seconds, peak_mb = measure(fn, df, repeat)
+            print(f"{name:<24} {rows:>10,} rows  {seconds * 1000:10.1f} ms  {peak_mb:9.1f} MB peak")
+            results.append({"case": name, "rows": rows, "seconds": seconds, "peak_mb": peak_mb})
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance: float):
+    """Return a line per case that got slower or heavier than baseline * tolerance."""
+    expected = {(r["case"], r["rows"]): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        base = expected.get((result["case"], result["rows"]))
+        if base is None:
+            continue
+        for metric in ("seconds", "peak_mb"):
+            if base[metric] > 0 and result[metric] > base[metric] * tolerance:
+                regressions.append(
+                    f"{result['case']} @ {result['rows']:,} rows: {metric} "
+                    f"{result[metric]:.4g} vs baseline {base[metric]:.4g}"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,100k,1M,10M", help="comma separated row counts, e.g. 10k,1M")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated case names")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--save-baseline", help="write results as the new baseline")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed ratio over the baseline")
+    args = parser.parse_args(argv)
+
+    cases = [name.strip() for name in args.cases.split(",")]
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    report = run([parse_size(size) for size in args.sizes.split(",")], cases, args.repeat)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,250 @@
 import redis.asyncio as redis
+import pyarrow as pa
+import pandas as pd
+import asyncio
+import json
+import uuid
+import zlib
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# Binary dataset payloads: MAGIC + 1 byte format version + Arrow IPC stream
+FRAME_MAGIC = b"HKDF"
+FRAME_VERSION = 1
+# rows per Arrow record batch, the unit for chunked reads of a cached frame
+FRAME_BATCH_ROWS = 256 * 1024
+
+# Stored value envelopes, anything without one of these prefixes is a plain value
+COMPRESSED_MAGIC = b"HKZ1"   # + 1 byte codec + compressed payload
+CHUNKED_MAGIC = b"HKC1"      # + JSON manifest, compressed payload split over `{key}:chunk:{id}:{i}`
+
+CODEC_ZSTD = 1
+CODEC_ZLIB = 2
 
 class RedisCache:
-    def __init__(self):
-        self.redis = redis.from_url("redis://localhost:6379")
+    def __init__(self, url="redis://localhost:6379", max_connections=50, socket_timeout=30,
+                 compress_threshold=64 * 1024, chunk_size=8 * 1024 * 1024, offload_threshold=1024 * 1024):
+        self.pool = redis.ConnectionPool.from_url(
+            url, max_connections=max_connections, socket_timeout=socket_timeout, health_check_interval=30
+        )
+        self.redis = redis.Redis(connection_pool=self.pool)
+        self.compress_threshold = compress_threshold
+        self.chunk_size = chunk_size
+        # encoding, compression and their inverses run in a worker thread from this many bytes on
+        self.offload_threshold = offload_threshold
+
+    async def _offload(self, size, fn, *args):
+        if size >= self.offload_threshold:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
 
     async def get(self, key):
-        value = await self.redis.get(key)
+        value = await self._read(key)
         return value.decode("utf-8") if value else None
 
     async def set(self, key, value, expire=4800):
-        await self.redis.set(key, value, ex=expire)
+        await self._write(key, value, expire)
 
     async def delete(self, key):
-        await self.redis.delete(key)
\ No newline at end of file
+        manifest = await self._manifest(key)
+        if manifest is not None:
+            await self.redis.delete(*self._chunk_keys(key, manifest))
+        await self.redis.delete(key)
+
+    async def delete_many(self, *keys):
+        # for values known to be below chunk_size, so there are no chunk keys to follow
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def exists(self, key):
+        return await self.redis.exists(key) > 0
+
+    async def exists_many(self, *keys):
+        # one round-trip, no payloads transferred
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.exists(key)
+            return [count > 0 for count in await pipe.execute()]
+
+    async def get_many(self, *keys):
+        return await self._load_many(keys, lambda value: value.decode("utf-8"))
+
+    async def set_many(self, items, expire=4800):
+        """
+        Write (key, value) pairs in one pipeline. For values that are never overwritten in place
+        and stay below chunk_size once compressed, such as the batches of a paged table, so no
+        manifest has to be probed. Compression runs off the event loop like in set().
+        """
+        items = list(items)
+        size = sum(len(value) for _, value in items)
+        packed = await self._offload(size, lambda: [(key, self.pack(value)) for key, value in items])
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in packed:
+                pipe.set(key, value, ex=expire)
+            await pipe.execute()
+
+    def lock(self, key, timeout=300, blocking_timeout=300):
+        return self.redis.lock(f"lock:{key}", timeout=timeout, blocking_timeout=blocking_timeout)
+
+    async def get_frame(self, key):
+        value = await self._read(key)
+        if not value:
+            return None
+        return await self._offload(len(value), decode_frame, value)
+
+    async def get_frames(self, *keys):
+        return await self._load_many(keys, decode_frame)
+
+    async def get_tables(self, *keys):
+        return await self._load_many(keys, decode_table)
+
+    async def _load_many(self, keys, decode):
+        # one MGET, then everything is decompressed and decoded together, off the loop when large
+        values = await self.redis.mget(keys)
+        values = [
+            await self._unwrap(key, value) if value and value.startswith(CHUNKED_MAGIC) else value
+            for key, value in zip(keys, values)
+        ]
+        size = sum(len(value) for value in values if value)
+        return await self._offload(size, lambda: [decode(unpack(value)) if value else None for value in values])
+
+    async def set_frame(self, key, df: pd.DataFrame, expire=4800):
+        value = await self._offload(int(df.memory_usage(index=False).sum()), encode_frame, df)
+        await self._write(key, value, expire)
+
+    async def _write(self, key, value, expire):
+        # chunks of the value being replaced are dropped once the new value is in place
+        previous = await self._manifest(key)
+        await self._write_value(key, value, expire)
+        if previous is not None:
+            await self.redis.delete(*self._chunk_keys(key, previous))
+
+    async def _write_value(self, key, value, expire):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) < self.compress_threshold:
+            await self.redis.set(key, value, ex=expire)
+            return
+
+        codec = CODEC_ZSTD if zstd is not None else CODEC_ZLIB
+        payload = await self._offload(len(value), compress, value, codec)
+        if len(payload) <= self.chunk_size:
+            await self.redis.set(key, COMPRESSED_MAGIC + bytes([codec]) + payload, ex=expire)
+            return
+
+        # chunks get a fresh id so readers never mix chunks of two writes, the manifest goes last
+        manifest = {"id": uuid.uuid4().hex, "codec": codec, "chunks": -(-len(payload) // self.chunk_size)}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for i, chunk_key in enumerate(self._chunk_keys(key, manifest)):
+                pipe.set(chunk_key, payload[i * self.chunk_size:(i + 1) * self.chunk_size], ex=expire)
+            await pipe.execute()
+        await self.redis.set(key, CHUNKED_MAGIC + json.dumps(manifest).encode("utf-8"), ex=expire)
+
+    def pack(self, value) -> bytes:
+        """Stored form of a value that is not chunked: as is below compress_threshold, compressed above."""
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) < self.compress_threshold:
+            return value
+        codec = CODEC_ZSTD if zstd is not None else CODEC_ZLIB
+        packed = COMPRESSED_MAGIC + bytes([codec]) + compress(value, codec)
+        if len(packed) > self.chunk_size:
+            raise ValueError(f"Value of {len(value)} bytes is too large to store unchunked")
+        return packed
+
+    async def _manifest(self, key):
+        """Chunk manifest of a chunked entry, None for any other value."""
+        prefix = await self.redis.getrange(key, 0, len(CHUNKED_MAGIC) - 1)
+        if prefix != CHUNKED_MAGIC:
+            return None
+        value = await self.redis.get(key)
+        if not value or not value.startswith(CHUNKED_MAGIC):
+            return None
+        return json.loads(value[len(CHUNKED_MAGIC):])
+
+    async def _read(self, key):
+        return await self._unwrap(key, await self.redis.get(key))
+
+    async def _unwrap(self, key, value):
+        if not value:
+            return None
+        if value.startswith(CHUNKED_MAGIC):
+            manifest = json.loads(value[len(CHUNKED_MAGIC):])
+            return await self._read_chunks(key, manifest)
+        return await self._offload(len(value), unpack, value)
+
+    async def _read_chunks(self, key, manifest):
+        # decompress chunk by chunk as they arrive instead of joining the compressed payload first
+        stream = decompressor(manifest["codec"])
+        output = bytearray()
+        for chunk_key in self._chunk_keys(key, manifest):
+            chunk = await self.redis.get(chunk_key)
+            if chunk is None:
+                # a chunk expired or was evicted, treat the whole entry as a miss
+                return None
+            output += await self._offload(len(chunk), stream.decompress, chunk)
+        return bytes(output)
+
+    def _chunk_keys(self, key, manifest):
+        return [f"{key}:chunk:{manifest['id']}:{i}" for i in range(manifest["chunks"])]
+
+
+def compress(value: bytes, codec: int) -> bytes:
+    if codec == CODEC_ZSTD:
+        return zstd.ZstdCompressor(level=3).compress(value)
+    return zlib.compress(value, 1)
+
+
+def unpack(value: bytes) -> bytes:
+    """Inverse of RedisCache.pack."""
+    if value.startswith(COMPRESSED_MAGIC):
+        return decompress(memoryview(value)[len(COMPRESSED_MAGIC) + 1:], value[len(COMPRESSED_MAGIC)])
+    return value
+
+
+def decompress(payload: bytes, codec: int) -> bytes:
+    return decompressor(codec).decompress(payload)
+
+
+def decompressor(codec: int):
+    if codec == CODEC_ZSTD:
+        if zstd is None:
+            raise ValueError("Cached value is zstd compressed but zstandard is not installed")
+        return zstd.ZstdDecompressor().decompressobj()
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    raise ValueError(f"Unsupported cache codec: {codec}")
+
+
+def encode_frame(df: pd.DataFrame) -> bytes:
+    return encode_table(pa.Table.from_pandas(df, preserve_index=False))
+
+
+def encode_table(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=FRAME_BATCH_ROWS)
+    return FRAME_MAGIC + bytes([FRAME_VERSION]) + sink.getvalue().to_pybytes()
+
+
+def decode_table(value: bytes) -> pa.Table:
+    """Arrow table over the payload buffer, nothing is converted to pandas yet."""
+    if not value.startswith(FRAME_MAGIC):
+        # entries written before the binary format was introduced
+        return pa.Table.from_pandas(pd.DataFrame(json.loads(value)), preserve_index=False)
+
+    version = value[len(FRAME_MAGIC)]
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported cache frame version: {version}")
+
+    buffer = pa.py_buffer(value)[len(FRAME_MAGIC) + 1:]
+    return pa.ipc.open_stream(buffer).read_all()
+
+
+def decode_frame(value: bytes) -> pd.DataFrame:
+    # zero-copy: the columns are read-only views over the payload, copy the frame before writing to it
+    return decode_table(value).to_pandas(split_blocks=True, self_destruct=True)
+
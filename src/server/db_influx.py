@@ -1,15 +1,77 @@
 from influxdb_client import InfluxDBClient
 from influxdb_client.client.exceptions import InfluxDBError
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import pandas as pd
+import functools
+import asyncio
+
+# Columns added by Flux/pivot that are not part of the dataset
+META_COLUMNS = ['result', 'table', '_start', '_stop', '_measurement', 'veh_no']
+
+
+def split_time_range(start_date: datetime, end_date: datetime, shards: int):
+    """Split [start_date, end_date) into consecutive, non-overlapping windows."""
+    # boundaries fall on whole seconds because the Flux range is rendered with second precision
+    total_seconds = int((end_date - start_date).total_seconds())
+    shards = max(1, min(shards, total_seconds))
+    bounds = [start_date + timedelta(seconds=round(i * total_seconds / shards)) for i in range(shards)]
+    bounds.append(end_date)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def flux_time_after(since: int) -> str:
+    # `since` is epoch ns, Flux range starts are inclusive so this is one nanosecond later
+    return pd.Timestamp(since + 1, tz='UTC').isoformat().replace('+00:00', 'Z')
+
 
 class InfluxDBHandler:
-    def __init__(self, url: str, token: str, org: str):
-        self.client = InfluxDBClient(url=url, token=token, org=org)
+    def __init__(self, url: str, token: str, org: str, max_concurrent_queries: int = 4, query_timeout: float = 120,
+                 shard_workers: int = 4, live_workers: int = 2):
+        # the HTTP timeout (ms) aborts the query itself, wait_for below only frees the caller
+        self.client = InfluxDBClient(url=url, token=token, org=org, timeout=int(query_timeout * 1000))
         self.query_api = self.client.query_api()
+        self.query_timeout = query_timeout
+        # bounded pool so blocking queries run off the event loop and excess requests queue up
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_queries, thread_name_prefix="influx-query")
+        # separate pool for shards, a sharded query already holds a slot in the pool above
+        self.shard_executor = ThreadPoolExecutor(max_workers=shard_workers, thread_name_prefix="influx-shard")
+        # live tail polls get their own pool, open tails never take slots from interactive queries
+        self.live_executor = ThreadPoolExecutor(max_workers=live_workers, thread_name_prefix="influx-live")
 
-    def query_data_from_influxdb(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
-        veh_no = item_no.split(" ")[1]
+    async def run_async(self, func, *args, **kwargs):
+        return await self.run_in(self.executor, func, *args, **kwargs)
+
+    async def run_in(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        return await asyncio.wait_for(loop.run_in_executor(executor, call), timeout=self.query_timeout)
+
+    async def query_data_async(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        return await self.run_async(self.query_data_from_influxdb, req_no, item_no, start_date, end_date, limit)
+
+    async def query_dataframe_async(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        return await self.run_async(self.query_dataframe_from_influxdb, req_no, item_no, start_date, end_date, limit)
 
+    async def query_dataframe_sharded_async(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, shards: int = 4):
+        return await self.run_async(self.query_dataframe_sharded, req_no, item_no, start_date, end_date, shards)
+
+    async def query_dataframes_batch_async(self, vehicles, start_date: datetime, end_date: datetime):
+        return await self.run_async(self.query_dataframes_batch, vehicles, start_date, end_date)
+
+    async def query_first_last_time_async(self, req_no: str, veh_no: str):
+        return await self.run_async(self.query_first_last_time, req_no, veh_no)
+
+    async def query_time_extent_async(self, req_no: str, veh_no: str):
+        return await self.run_async(self.query_time_extent, req_no, veh_no)
+
+    async def query_extent_since_async(self, req_no: str, veh_no: str, since: int):
+        return await self.run_async(self.query_extent_since, req_no, veh_no, since)
+
+    async def query_since_async(self, req_no: str, veh_no: str, since: int, limit: int = None):
+        return await self.run_in(self.live_executor, self.query_since, req_no, veh_no, since, limit)
+
+    def build_query(self, req_no: str, veh_no: str, start_date: datetime, end_date: datetime, limit: int = None):
         query = f'''
             from(bucket: "hkcodeplayground")
                 |> range(start: {start_date.strftime('%Y-%m-%dT%H:%M:%SZ')}, stop: {end_date.strftime('%Y-%m-%dT%H:%M:%SZ')})
@@ -19,52 +81,217 @@ class InfluxDBHandler:
         if limit is not None:
             query += f'|> limit(n: {limit})'
         query += '|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+        return query
+
+    def build_tail_query(self, req_no: str, veh_no: str, since: int, limit: int = None):
+        query = f'''
+            from(bucket: "hkcodeplayground")
+                |> range(start: {flux_time_after(since)})
+                |> filter(fn: (r) => r["_measurement"] == "IMU" and r["req_no"] == "{req_no}" and r["veh_no"] == "{veh_no}")
+                |> sort(columns: ["_time"], desc: false)
+            '''
+        if limit is not None:
+            query += f'|> limit(n: {limit})'
+        query += '|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+        return query
+
+    def build_batch_query(self, vehicles, start_date: datetime, end_date: datetime):
+        # one table per (req_no, veh_no) group, so sort and pivot stay per vehicle
+        predicate = " or ".join(
+            f'(r["req_no"] == "{req_no}" and r["veh_no"] == "{veh_no}")' for req_no, veh_no in vehicles
+        )
+        return f'''
+            from(bucket: "hkcodeplayground")
+                |> range(start: {start_date.strftime('%Y-%m-%dT%H:%M:%SZ')}, stop: {end_date.strftime('%Y-%m-%dT%H:%M:%SZ')})
+                |> filter(fn: (r) => r["_measurement"] == "IMU")
+                |> filter(fn: (r) => {predicate})
+                |> sort(columns: ["_time"], desc: false)
+                |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+            '''
+
+    def iter_records(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        """Yield pivoted rows one at a time without holding the whole range in memory."""
+        veh_no = item_no.split(" ")[1]
+        query = self.build_query(req_no, veh_no, start_date, end_date, limit)
         try:
-            tables = self.query_api.query(org=self.client.org, query=query)
+            records = self.query_api.query_stream(org=self.client.org, query=query)
         except InfluxDBError as e:
             print(f"InfluxDB query error: {e}")
             raise
 
-        data_list = []
-        for table in tables:
-            for record in table.records:
-                if record is None:
-                    continue
-                data = record.values
-                timestamp_str = data.pop('_time').strftime('%Y-%m-%d %H:%M:%S')
-                del_key_list = ['result', 'table', '_start', '_stop', '_measurement', 'veh_no']
-                for key in del_key_list:
-                    del data[key]
-                ordered_data = {'timestamp': timestamp_str}
-                ordered_data.update(data)
-                data_list.append(ordered_data)
-        return data_list
-    
+        for record in records:
+            if record is None:
+                continue
+            data = record.values
+            timestamp_str = data.pop('_time').strftime('%Y-%m-%d %H:%M:%S')
+            for key in META_COLUMNS:
+                data.pop(key, None)
+            ordered_data = {'timestamp': timestamp_str}
+            ordered_data.update(data)
+            yield ordered_data
 
-    def query_first_last_time(self, req_no:str, veh_no: str):
+    def query_data_from_influxdb(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        return list(self.iter_records(req_no, item_no, start_date, end_date, limit))
+
+    def iter_data_frames(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        """
+        Yield the pivoted result as DataFrame chunks, straight from the Flux CSV stream.
+        `timestamp` is an int64 epoch in nanoseconds (UTC).
+        """
+        veh_no = item_no.split(" ")[1]
+        query = self.build_query(req_no, veh_no, start_date, end_date, limit)
         try:
-            query_first = f'''
-            from(bucket: "hkcodeplayground")
-                |> range(start: 0)
-                |> filter(fn: (r) => r["_measurement"] == "IMU" and r["req_no"] == "{req_no}" and r["veh_no"] == "{veh_no}")
-                |> sort(columns: ["_time"], desc: false)
-                |> limit(n: 1)
-            '''
-            first_result = self.query_api.query(org=self.client.org, query=query_first)
-            first_time = first_result[0].records[0].get_time()
+            frames = self.query_api.query_data_frame_stream(query=query, org=self.client.org)
+        except InfluxDBError as e:
+            print(f"InfluxDB query error: {e}")
+            raise
 
-            query_last = f'''
-            from(bucket: "hkcodeplayground")
+        for chunk in frames:
+            if chunk is None or chunk.empty:
+                continue
+            yield self._normalize_frame(chunk)
+
+    def query_dataframe_from_influxdb(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, limit: int = None):
+        chunks = list(self.iter_data_frames(req_no, item_no, start_date, end_date, limit))
+        if not chunks:
+            return pd.DataFrame(columns=['timestamp'])
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True, copy=False)
+
+    def query_dataframes_batch(self, vehicles, start_date: datetime, end_date: datetime):
+        """
+        Fetch several vehicles with one query. `vehicles` is a list of (req_no, item_no)
+        pairs, the result maps each pair to its DataFrame (empty if it has no data).
+        """
+        item_by_veh = {(req_no, item_no.split(" ")[1]): item_no for req_no, item_no in vehicles}
+        query = self.build_batch_query(list(item_by_veh), start_date, end_date)
+        try:
+            frames = self.query_api.query_data_frame_stream(query=query, org=self.client.org)
+        except InfluxDBError as e:
+            print(f"InfluxDB query error: {e}")
+            raise
+
+        chunks = {pair: [] for pair in vehicles}
+        for chunk in frames:
+            if chunk is None or chunk.empty:
+                continue
+            item_no = item_by_veh.get((chunk['req_no'].iat[0], chunk['veh_no'].iat[0]))
+            if item_no is None:
+                continue
+            chunks[(chunk['req_no'].iat[0], item_no)].append(self._normalize_frame(chunk))
+
+        result = {}
+        for pair, parts in chunks.items():
+            if not parts:
+                result[pair] = pd.DataFrame(columns=['timestamp'])
+            elif len(parts) == 1:
+                result[pair] = parts[0]
+            else:
+                result[pair] = pd.concat(parts, ignore_index=True, copy=False)
+        return result
+
+    def query_dataframe_sharded(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime, shards: int = 4):
+        """
+        Fetch the range as `shards` time windows in parallel. Windows are disjoint and each one
+        comes back sorted, so concatenating them in window order keeps the result in time order.
+        """
+        windows = split_time_range(start_date, end_date, shards)
+        if len(windows) == 1:
+            return self.query_dataframe_from_influxdb(req_no, item_no, start_date, end_date)
+
+        frames = self.shard_executor.map(
+            lambda window: self.query_dataframe_from_influxdb(req_no, item_no, window[0], window[1]), windows
+        )
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame(columns=['timestamp'])
+        return pd.concat(frames, ignore_index=True, copy=False)
+
+    def query_since(self, req_no: str, veh_no: str, since: int, limit: int = None):
+        """Rows strictly after `since` (epoch ns), for tailing a vehicle that is still recording."""
+        query = self.build_tail_query(req_no, veh_no, since, limit)
+        try:
+            frames = self.query_api.query_data_frame_stream(query=query, org=self.client.org)
+        except InfluxDBError as e:
+            print(f"InfluxDB query error: {e}")
+            raise
+
+        chunks = [self._normalize_frame(chunk) for chunk in frames if chunk is not None and not chunk.empty]
+        if not chunks:
+            return pd.DataFrame(columns=['timestamp'])
+        return pd.concat(chunks, ignore_index=True, copy=False)
+
+    @staticmethod
+    def _normalize_frame(chunk: pd.DataFrame) -> pd.DataFrame:
+        timestamps = pd.DatetimeIndex(chunk['_time']).asi8
+        chunk = chunk.drop(columns=[c for c in META_COLUMNS + ['_time'] if c in chunk.columns])
+        chunk.insert(0, 'timestamp', timestamps)
+        return chunk.reset_index(drop=True)
+
+
+    def query_time_extent(self, req_no: str, veh_no: str):
+        """
+        First/last timestamp (epoch ns) and row count of a vehicle in a single query.
+        first()/last()/count() run per field series in storage, only the reduced rows come back.
+        """
+        query = f'''
+            data = from(bucket: "hkcodeplayground")
                 |> range(start: 0)
                 |> filter(fn: (r) => r["_measurement"] == "IMU" and r["req_no"] == "{req_no}" and r["veh_no"] == "{veh_no}")
-                |> sort(columns: ["_time"], desc: true)
-                |> limit(n: 1)
+            data |> first() |> keep(columns: ["_time"]) |> group() |> min(column: "_time") |> yield(name: "first")
+            data |> last() |> keep(columns: ["_time"]) |> group() |> max(column: "_time") |> yield(name: "last")
+            data |> count() |> keep(columns: ["_value"]) |> group() |> max(column: "_value") |> yield(name: "count")
             '''
-            last_result = self.query_api.query(org=self.client.org, query=query_last)
-            last_time = last_result[0].records[0].get_time()
+        try:
+            tables = self.query_api.query(org=self.client.org, query=query)
+        except InfluxDBError as e:
+            print(f"InfluxDB query error: {e}")
+            raise
 
-            return first_time, last_time
+        extent = {}
+        for table in tables:
+            for record in table.records:
+                name = record.values.get('result')
+                if name in ('first', 'last'):
+                    extent[name] = pd.Timestamp(record.get_time()).value
+                elif name == 'count':
+                    extent['count'] = int(record.get_value())
+        if 'first' not in extent or 'last' not in extent:
+            return None
+        extent.setdefault('count', 0)
+        return extent
 
+    def query_extent_since(self, req_no: str, veh_no: str, since: int):
+        """Last timestamp (epoch ns) and row count after `since`, None if nothing was written since."""
+        query = f'''
+            data = from(bucket: "hkcodeplayground")
+                |> range(start: {flux_time_after(since)})
+                |> filter(fn: (r) => r["_measurement"] == "IMU" and r["req_no"] == "{req_no}" and r["veh_no"] == "{veh_no}")
+            data |> last() |> keep(columns: ["_time"]) |> group() |> max(column: "_time") |> yield(name: "last")
+            data |> count() |> keep(columns: ["_value"]) |> group() |> max(column: "_value") |> yield(name: "count")
+            '''
+        try:
+            tables = self.query_api.query(org=self.client.org, query=query)
         except InfluxDBError as e:
             print(f"InfluxDB query error: {e}")
-            raise
\ No newline at end of file
+            raise
+
+        extent = {}
+        for table in tables:
+            for record in table.records:
+                name = record.values.get('result')
+                if name == 'last':
+                    extent['last'] = pd.Timestamp(record.get_time()).value
+                elif name == 'count':
+                    extent['count'] = int(record.get_value())
+        if 'last' not in extent:
+            return None
+        extent.setdefault('count', 0)
+        return extent
+
+    def query_first_last_time(self, req_no:str, veh_no: str):
+        extent = self.query_time_extent(req_no, veh_no)
+        if extent is None:
+            raise ValueError(f"No data for req_no {req_no}, veh_no {veh_no}")
+        return pd.Timestamp(extent['first'], tz='UTC').to_pydatetime(), pd.Timestamp(extent['last'], tz='UTC').to_pydatetime()
@@ -0,0 +1,71 @@
+import pandas as pd
+import json
+import logging
+import time
+
+
+class TimeExtentIndex:
+    """
+    First/last timestamp and row count per (req_no, veh_no), kept in Redis with a TTL.
+    Filled by one first()/last()/count() query and extended as new data is fetched. A vehicle may
+    still be recording, so an entry older than `refresh_after` seconds has its end re-checked with
+    a query over the rows after the known last timestamp only.
+    """
+
+    def __init__(self, cache, influx_handler, expire: int = 86400, refresh_after: float = 60):
+        self.cache = cache
+        self.influx_handler = influx_handler
+        self.expire = expire
+        self.refresh_after = refresh_after
+
+    def key(self, req_no: str, veh_no: str) -> str:
+        return f"extent:{req_no}:{veh_no}"
+
+    async def get(self, req_no: str, veh_no: str):
+        cached = await self.cache.get(self.key(req_no, veh_no))
+        if cached:
+            extent = json.loads(cached)
+            if time.time() - extent.get('checked', 0) < self.refresh_after:
+                return extent
+            return await self.refresh(req_no, veh_no, extent)
+
+        logging.info(f"Time extent miss for {req_no}/{veh_no}. Querying InfluxDB.")
+        extent = await self.influx_handler.query_time_extent_async(req_no, veh_no)
+        if extent is not None:
+            extent['checked'] = time.time()
+            await self.cache.set(self.key(req_no, veh_no), json.dumps(extent), expire=self.expire)
+        return extent
+
+    async def refresh(self, req_no: str, veh_no: str, extent: dict):
+        try:
+            tail = await self.influx_handler.query_extent_since_async(req_no, veh_no, extent['last'])
+        except Exception as e:
+            logging.warning(f"Could not refresh time extent for {req_no}/{veh_no}: {e}")
+            return extent
+
+        if tail is not None:
+            extent['last'] = max(extent['last'], tail['last'])
+            extent['count'] += tail['count']
+        extent['checked'] = time.time()
+        await self.cache.set(self.key(req_no, veh_no), json.dumps(extent), expire=self.expire)
+        return extent
+
+    async def observe(self, req_no: str, veh_no: str, df: pd.DataFrame):
+        """Extend an existing entry with rows that fall outside its known extent."""
+        if df.empty:
+            return
+        cached = await self.cache.get(self.key(req_no, veh_no))
+        if not cached:
+            return
+
+        extent = json.loads(cached)
+        timestamps = df['timestamp'].to_numpy()
+        before = timestamps < extent['first']
+        after = timestamps > extent['last']
+        if not before.any() and not after.any():
+            return
+
+        extent['count'] += int(before.sum() + after.sum())
+        extent['first'] = min(extent['first'], int(timestamps[0]))
+        extent['last'] = max(extent['last'], int(timestamps[-1]))
+        await self.cache.set(self.key(req_no, veh_no), json.dumps(extent), expire=self.expire)
@@ -1,86 +1,390 @@
 import pandas as pd
 import numpy as np
+import re
+from collections import deque
+from pandas.errors import UndefinedVariableError
+from tokenize import TokenError
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.ndimage import gaussian_filter1d
 
+# Filter layers are stored as the surviving base row positions plus any columns whose values were changed
+ROW_COLUMN = '_row'
+
+
+def layer_overrides(layer: pd.DataFrame):
+    return set(layer.columns) - {ROW_COLUMN}
+
+
+def apply_filter_layer(base: pd.DataFrame, layer: pd.DataFrame) -> pd.DataFrame:
+    """Materialize a filter layer over its base dataset, keeping base row positions as the index."""
+    rows = layer[ROW_COLUMN].to_numpy()
+    df = base.take(rows)
+    for col in layer_overrides(layer):
+        df[col] = layer[col].to_numpy()
+    return df
+
+
+# Array kernels shared by the fused pipeline and the DataFrame filters below
+NUMERIC_OPERATIONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+
+# sketch quartiles are only used when their error bound is at most this fraction of the IQR
+SKETCH_IQR_TOLERANCE = 0.01
+
+
+def sketch_quartiles(sketch, tolerance: float = SKETCH_IQR_TOLERANCE):
+    """
+    Q1/Q3 from a QuantileSketch, or None when they are not accurate enough for IQR bounds. The
+    sketch error is relative to the value, so on a column with a large offset (latitude, gravity)
+    it can be as wide as the IQR itself, and the exact quantiles have to be computed instead.
+    """
+    q1, q3 = sketch.quantile(0.25), sketch.quantile(0.75)
+    bound = sketch.relative_accuracy * (abs(q1) + abs(q3))
+    if not q3 > q1 or bound > tolerance * (q3 - q1):
+        return None
+    return q1, q3
+
+
+def iqr_mask(values: np.ndarray, quartiles=None) -> np.ndarray:
+    Q1, Q3 = quartiles if quartiles is not None else np.nanquantile(values, [0.25, 0.75])
+    IQR = Q3 - Q1
+    return (values >= Q1 - 1.5 * IQR) & (values <= Q3 + 1.5 * IQR)
+
+
+def centered_rolling(values: np.ndarray, window: int, reducer) -> np.ndarray:
+    """
+    Same alignment and NaN edges as pandas `rolling(window, center=True)`, but every window is
+    reduced on its own, so the result does not depend on where the array starts (see stream_with_halo).
+    """
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        right = (window - 1) // 2
+        left = window - 1 - right
+        out[left:len(values) - right] = reducer(sliding_window_view(values, window), axis=1)
+    return out
+
+
+def moving_average_mask(values: np.ndarray, window_size: int = 5, threshold: float = 1.5) -> np.ndarray:
+    moving_avg = centered_rolling(values, window_size, np.mean)
+    deviation = np.abs(values - moving_avg)
+    median_deviation = centered_rolling(deviation, window_size, np.median)
+    return deviation <= (threshold * median_deviation)
+
+
+def moving_average_halo(window_size: int) -> int:
+    # the mask at i needs deviations within one window, each of which needs values within one window
+    return 2 * (window_size - 1 - (window_size - 1) // 2)
+
+
+def gaussian_halo(sigma: float, truncate: float = 4.0) -> int:
+    # kernel radius used by scipy's gaussian_filter1d
+    return int(truncate * float(sigma) + 0.5)
+
+
+def stream_with_halo(chunks, halo: int, kernel):
+    """
+    Apply `kernel` (array -> array of the same length) to a column given as an iterable of chunks,
+    yielding the result chunk by chunk. Each chunk is processed together with `halo` neighbouring
+    samples on both sides, so the output equals `kernel` applied to the whole column while the
+    kernel's temporaries only cover about one chunk plus halos.
+    """
+    buffer = None
+    lead = 0  # samples at the start of the buffer that were already emitted and only serve as halo
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        buffer = chunk if buffer is None else np.concatenate([buffer, chunk])
+        ready = len(buffer) - lead - halo
+        if ready <= 0:
+            continue
+        yield kernel(buffer)[lead:lead + ready]
+        keep_from = max(lead + ready - halo, 0)
+        buffer = buffer[keep_from:]
+        lead = lead + ready - keep_from
+
+    if buffer is not None and len(buffer) > lead:
+        # the real end of the column, edge handling now matches the in-memory kernel
+        yield kernel(buffer)[lead:]
+
+
+def stream_aligned(chunks, halo: int, kernel):
+    """
+    stream_with_halo over (positions, values) chunks: yields (positions, values, kernel output)
+    for the same rows, so the result can be matched back to the rows it belongs to.
+    """
+    pending = deque()
+
+    def values_of(chunks):
+        for positions, values in chunks:
+            pending.append((positions, values))
+            yield values
+
+    for out in stream_with_halo(values_of(chunks), halo, kernel):
+        # the output covers the oldest pending rows, possibly only part of a chunk
+        positions, values = take_front(pending, len(out))
+        yield positions, values, out
+
+
+def take_front(pending, count: int):
+    parts = []
+    while count > 0:
+        positions, values = pending.popleft()
+        if len(values) > count:
+            pending.appendleft((positions[count:], values[count:]))
+            positions, values = positions[:count], values[:count]
+        parts.append((positions, values))
+        count -= len(values)
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate([p for p, _ in parts]), np.concatenate([v for _, v in parts])
+
+
+def stream_gaussian_smoothing(chunks, sigma: float = 1.0):
+    """(positions, values) chunks -> (positions, smoothed values), equal to smoothing the whole column."""
+    kernel = lambda values: gaussian_filter1d(values, sigma=sigma)
+    for positions, _, smoothed in stream_aligned(chunks, gaussian_halo(sigma), kernel):
+        yield positions, smoothed
+
+
+def stream_moving_average_mask(chunks, window_size: int = 5, threshold: float = 1.5):
+    """(positions, values) chunks -> the rows of each chunk that pass the moving average filter."""
+    kernel = lambda values: moving_average_mask(values, window_size, threshold)
+    for positions, values, keep in stream_aligned(chunks, moving_average_halo(window_size), kernel):
+        yield positions[keep], values[keep]
+
+
+def masked_chunks(chunks, condition):
+    for positions, values in chunks:
+        keep = condition(values)
+        yield positions[keep], values[keep]
+
+
+def split_chunks(positions: np.ndarray, values: np.ndarray, chunk_size):
+    """An in-memory column as (positions, values) chunks, a single one when chunk_size is None."""
+    chunk_size = chunk_size or max(len(values), 1)
+    for start in range(0, len(values), chunk_size):
+        yield positions[start:start + chunk_size], values[start:start + chunk_size]
+
+
+def collect_chunks(chunks, dtype):
+    # the pieces are only joined once, at the end of the pipeline
+    pieces = list(chunks)
+    if not pieces:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)
+    return np.concatenate([p for p, _ in pieces]), np.concatenate([v for _, v in pieces])
+
+
+# Filters read and process columns this many rows at a time. Rolling and Gaussian steps carry halos
+# across chunk borders, so the result is the same as for the whole column at once
+STREAMING_CHUNK_SIZE = 1_000_000
+
+
+class FilterExpression:
+    """
+    Multi-column condition such as `x > 0.5 and abs(z) < 2 and speed between 10 and 80`,
+    validated against the dataset columns and evaluated in one vectorized DataFrame.eval pass.
+    """
+
+    TOKEN_RE = re.compile(
+        r"\s*(?:(?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)"
+        r"|(?P<name>[A-Za-z_][A-Za-z0-9_]*)"
+        r"|(?P<quoted>`[^`]+`)"
+        r"|(?P<op>==|!=|>=|<=|>|<|\(|\)|\+|-|\*|/))"
+    )
+    KEYWORDS = {'and', 'or', 'not'}
+    FUNCTIONS = {'abs'}
+
+    def __init__(self, expression: str, columns):
+        self.expression = expression
+        self.columns = set()
+        self.compiled = self._compile(self._tokenize(expression), set(columns))
+
+    def _tokenize(self, expression):
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            match = self.TOKEN_RE.match(expression, pos)
+            if match is None or match.end() == pos:
+                raise ValueError(f"Invalid filter expression near: {expression[pos:pos + 10]!r}")
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind)))
+            pos = match.end()
+        return tokens
+
+    def _column(self, kind, text, columns):
+        name = text.strip('`') if kind == 'quoted' else text
+        if name not in columns:
+            raise ValueError(f"Unknown column in filter expression: {name}")
+        self.columns.add(name)
+        return f"`{name}`"
+
+    def _bound(self, tokens, i):
+        # a numeric literal with an optional sign, returns (text, next index)
+        sign = ''
+        if i < len(tokens) and tokens[i] == ('op', '-'):
+            sign, i = '-', i + 1
+        if i >= len(tokens) or tokens[i][0] != 'number':
+            raise ValueError("`between` bounds must be numbers")
+        return sign + tokens[i][1], i + 1
+
+    def _compile(self, tokens, columns):
+        out = []
+        i = 0
+        while i < len(tokens):
+            kind, text = tokens[i]
+            if kind == 'name' and text.lower() in self.KEYWORDS:
+                out.append(text.lower())
+            elif kind == 'name' and text in self.FUNCTIONS:
+                out.append(text)
+            elif kind in ('name', 'quoted'):
+                column = self._column(kind, text, columns)
+                if i + 1 < len(tokens) and tokens[i + 1][0] == 'name' and tokens[i + 1][1].lower() == 'between':
+                    low, i = self._bound(tokens, i + 2)
+                    if i >= len(tokens) or tokens[i][1].lower() != 'and':
+                        raise ValueError("Expected `and` in `between` condition")
+                    high, i = self._bound(tokens, i + 1)
+                    out.append(f"({column} >= {low} and {column} <= {high})")
+                    continue
+                out.append(column)
+            else:
+                out.append(text)
+            i += 1
+        if not self.columns:
+            raise ValueError("Filter expression does not reference any column")
+        return " ".join(out)
+
+    def evaluate(self, df: pd.DataFrame) -> np.ndarray:
+        try:
+            result = df.eval(self.compiled)
+        except (SyntaxError, TokenError, UndefinedVariableError, TypeError) as e:
+            # malformed input such as a trailing `and`, reported like the other validation errors
+            raise ValueError(f"Invalid filter expression: {self.expression}") from e
+        mask = np.asarray(result)
+        if mask.dtype != bool or mask.shape != (len(df),):
+            raise ValueError("Filter expression must evaluate to a condition")
+        return mask
+
+
 class DataFilter:
-    def __init__(self, data, selected_filter, input_value, checkboxes, column):
-        self.df = pd.DataFrame(data)
+    def __init__(self, data, selected_filter, input_value, checkboxes, column, chunk_size=STREAMING_CHUNK_SIZE,
+                 sketch=None):
+        # no data when the column is passed to select_chunks()
+        self.df = pd.DataFrame(data) if data is not None else None
+        self.chunk_size = chunk_size
+        # optional QuantileSketch of the unfiltered column, answers IQR bounds without a sort
+        self.sketch = sketch
         self.selected_filter = selected_filter
         self.input_value = input_value
         self.checkboxes = checkboxes
         self.column = column
+        # columns whose values are changed (not just subset) by the applied filters
+        self.modified_columns = set()
 
     def apply_filter(self):
-        filtered_df = self.df
+        positions, overrides = self.select()
+        filtered_df = self.df.take(positions)
+        for col, values in overrides.items():
+            filtered_df[col] = values
+        return filtered_df
+
+    def select(self):
+        """
+        Run the whole filter chain on the target column's array and return the positions of the
+        surviving rows in self.df, plus new values (aligned with positions) for smoothed columns.
+        No intermediate DataFrame is built.
+        """
+        values = self.df[self.column].to_numpy()
+        return self.select_chunks(split_chunks(np.arange(len(values)), values, self.chunk_size), values.dtype)
+
+    def select_chunks(self, chunks, dtype=float):
+        """
+        select() over the target column given as (positions, values) chunks in row order, e.g. read
+        batch by batch from the cache. Every step is chained lazily over the chunks, so only about
+        one chunk per step is held at a time; IQR without usable sketch quartiles is the exception,
+        its quartiles need the whole column as filtered so far.
+        """
+        stream = chunks
+        smoothed = False
+        # the sketch describes the column as given, it is only valid until the values change
+        untouched = True
 
         # Apply numeric filter first if an input value is provided
         if self.input_value:
-            filtered_df = self.apply_numeric_filter(filtered_df, self.selected_filter, self.column, self.input_value)
-
-        # Define the filters available
-        filters = {
-            'iqr': self.iqr_filter,
-            'movingAvg': self.moving_average_filter,
-            'gaussian': self.gaussian_smoothing
-        }
+            condition = self.numeric_condition(self.selected_filter, self.input_value)
+            if condition is not None:
+                stream = masked_chunks(stream, condition)
+                untouched = False
 
         # Apply each selected filter from checkboxes
         for key, apply in self.checkboxes.items():
-            if apply and key in filters:
-                filtered_df = filters[key](filtered_df, self.column)
+            if not apply:
+                continue
+            if key == 'iqr':
+                quartiles = None
+                if untouched and self.sketch is not None:
+                    quartiles = sketch_quartiles(self.sketch)
+                if quartiles is None:
+                    positions, values = collect_chunks(stream, dtype)
+                    keep = iqr_mask(values)
+                    stream = split_chunks(positions[keep], values[keep], self.chunk_size)
+                else:
+                    stream = masked_chunks(stream, lambda values, quartiles=quartiles: iqr_mask(values, quartiles))
+            elif key == 'movingAvg':
+                stream = stream_moving_average_mask(stream)
+            elif key == 'gaussian':
+                stream = stream_gaussian_smoothing(stream)
+                smoothed = True
+            else:
+                continue
+            untouched = False
 
-        return filtered_df
+        positions, values = collect_chunks(stream, dtype)
+        if smoothed:
+            self.modified_columns.add(self.column)
+            return positions, {self.column: values}
+        return positions, {}
 
-    def apply_numeric_filter(self, df, selected_filter, column, input_value):
+    def gaussian_values(self, values, sigma: float = 1.0):
+        chunks = split_chunks(np.arange(len(values)), values, self.chunk_size)
+        return collect_chunks(stream_gaussian_smoothing(chunks, sigma), values.dtype)[1]
+
+    def numeric_condition(self, selected_filter, input_value):
+        """values -> mask for the numeric filter, None if the filter or value is not valid."""
         try:
             input_value = float(input_value)
         except ValueError:
-            return df
-
-        operations = {
-            "=": lambda df, column, value: df[df[column] == value],
-            "!=": lambda df, column, value: df[df[column] != value],
-            ">": lambda df, column, value: df[df[column] > value],
-            ">=": lambda df, column, value: df[df[column] >= value],
-            "<": lambda df, column, value: df[df[column] < value],
-            "<=": lambda df, column, value: df[df[column] <= value],
-        }
-
-        if selected_filter in operations:
-            return operations[selected_filter](df, column, input_value)
-        else:
-            return df
+            return None
+
+        if selected_filter in NUMERIC_OPERATIONS:
+            return lambda values: NUMERIC_OPERATIONS[selected_filter](values, input_value)
+        return None
+
+    def numeric_mask(self, values, selected_filter, input_value):
+        condition = self.numeric_condition(selected_filter, input_value)
+        return None if condition is None else condition(values)
+
+    def apply_numeric_filter(self, df, selected_filter, column, input_value):
+        mask = self.numeric_mask(df[column].to_numpy(), selected_filter, input_value)
+        return df if mask is None else df[mask]
 
     def iqr_filter(self, df: pd.DataFrame, column: str) -> pd.DataFrame:
-        Q1 = df[column].quantile(0.25)
-        Q3 = df[column].quantile(0.75)
-        IQR = Q3 - Q1
-        
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        
-        filtered_df = df[(df[column] >= lower_bound) & (df[column] <= upper_bound)]
-        
-        return filtered_df
+        return df[iqr_mask(df[column].to_numpy())]
 
     def moving_average_filter(self, df: pd.DataFrame, column: str, window_size: int = 5, threshold: float = 1.5) -> pd.DataFrame:
-        moving_avg = df[column].rolling(window=window_size, center=True).mean()
-        deviation = np.abs(df[column] - moving_avg)
-        median_deviation = deviation.rolling(window=window_size, center=True).median()
-        
-        filtered_df = df[deviation <= (threshold * median_deviation)]
-        
-        return filtered_df
+        return df[moving_average_mask(df[column].to_numpy(), window_size, threshold)]
 
     def gaussian_smoothing(self, df: pd.DataFrame, column: str, sigma: float = 1.0) -> pd.DataFrame:
-        smoothed_values = gaussian_filter1d(df[column].values, sigma=sigma)
-        
+        smoothed_values = self.gaussian_values(df[column].values, sigma=sigma)
+
         smoothed_df = df.copy()
         smoothed_df[column] = smoothed_values
-        
-        return smoothed_df
-    
-
+        self.modified_columns.add(column)
 
-
-    
+        return smoothed_df
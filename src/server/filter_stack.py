@@ -0,0 +1,198 @@
+from filter import DataFilter, FilterExpression, ROW_COLUMN, STREAMING_CHUNK_SIZE, layer_overrides, split_chunks
+import numpy as np
+import pandas as pd
+import asyncio
+import hashlib
+import json
+import logging
+
+
+def layer_chunks(read_base, layer, columns):
+    """
+    The rows of `layer` (None for the whole base) as (positions in the layer, {column: values})
+    chunks in row order. Columns an earlier step smoothed come from the layer, the others are read
+    from the base with read_base(columns), an iterable of Arrow tables covering the base in order.
+    """
+    rows = None if layer is None else layer[ROW_COLUMN].to_numpy()
+    previous = {} if layer is None else {col: layer[col].to_numpy() for col in layer_overrides(layer)}
+    from_base = [col for col in columns if col not in previous]
+    if not from_base:
+        # every column was smoothed, the base is not read at all
+        for positions, _ in split_chunks(np.arange(len(rows)), rows, STREAMING_CHUNK_SIZE):
+            yield positions, {col: previous[col][positions] for col in columns}
+        return
+
+    start = 0
+    for table in read_base(from_base):
+        if rows is None:
+            lo, hi = start, start + table.num_rows
+            selected = slice(None)
+        else:
+            # layer rows are ascending base positions, the ones in this table are a contiguous run
+            lo, hi = np.searchsorted(rows, [start, start + table.num_rows])
+            selected = rows[lo:hi] - start
+        yield np.arange(lo, hi), {
+            col: previous[col][lo:hi] if col in previous else table.column(col).to_numpy()[selected]
+            for col in columns
+        }
+        start += table.num_rows
+
+
+def next_layer(layer, positions, changed=None) -> pd.DataFrame:
+    """The layer keeping the rows at `positions` of `layer` (of the base when None), with `changed` values."""
+    rows = positions if layer is None else layer[ROW_COLUMN].to_numpy()[positions]
+    new_layer = pd.DataFrame({ROW_COLUMN: rows.astype(np.uint32)})
+    if layer is not None:
+        for col in layer_overrides(layer):
+            new_layer[col] = layer[col].to_numpy()[positions]
+    for col, col_values in (changed or {}).items():
+        new_layer[col] = col_values
+    return new_layer
+
+
+def apply_step(read_base, columns, layer, step: dict, sketches=None) -> pd.DataFrame:
+    """
+    Run one /filtering step on top of `layer` (None for the base data) and return the new layer.
+    The base is never loaded as a whole: read_base(columns) yields it as Arrow tables in row order,
+    and only the columns the step needs are read. `columns` are the base column names.
+    """
+    if 'expression' in step:
+        return apply_expression_step(read_base, columns, layer, step['expression'])
+
+    column = step.get('header')
+    if column not in columns:
+        raise ValueError(f"Unknown column: {column}")
+    # dataset sketches describe the base column, so they only apply to the first layer
+    sketch = sketches.get(column) if sketches and layer is None else None
+    filterClass = DataFilter(
+        data=None, selected_filter=step['selectedFilter'],
+        input_value=step['inputValue'], checkboxes=step['checkboxes'], column=column, sketch=sketch
+    )
+    chunks = ((positions, data[column]) for positions, data in layer_chunks(read_base, layer, [column]))
+    positions, changed = filterClass.select_chunks(chunks)
+    return next_layer(layer, positions, changed)
+
+
+def apply_expression_step(read_base, columns, layer, expression: str) -> pd.DataFrame:
+    expr = FilterExpression(expression, columns)
+    # the condition is row-wise, so it is evaluated chunk by chunk on the referenced columns only,
+    # using smoothed values where an earlier step changed them
+    kept = [
+        positions[expr.evaluate(pd.DataFrame(data))]
+        for positions, data in layer_chunks(read_base, layer, sorted(expr.columns))
+    ]
+    positions = np.concatenate(kept) if kept else np.empty(0, dtype=np.int64)
+    return next_layer(layer, positions)
+
+
+class FilterStack:
+    """
+    Versioned filter pipeline per dataset. The stack keeps every step and how many of them
+    are active, so undo/redo just move the position. Each layer is cached under a hash chained
+    from the dataset write and all steps up to it, so editing a step only recomputes the layers
+    after it and layers of an earlier fill of the same key are never reused.
+    """
+
+    def __init__(self, cache, expire: int = 4800):
+        self.cache = cache
+        self.expire = expire
+
+    def stack_key(self, cache_key: str) -> str:
+        return f"{cache_key}:filters"
+
+    def layer_key(self, cache_key: str, layer_hash: str) -> str:
+        return f"{cache_key}:layer:{layer_hash}"
+
+    def version_key(self, cache_key: str) -> str:
+        return f"{cache_key}:version"
+
+    async def data_version(self, cache_key: str) -> str:
+        # layers hold base row positions, so they are only valid for the write they were computed on
+        return await self.cache.get(f"{cache_key}:data_version") or ""
+
+    async def load(self, cache_key: str) -> dict:
+        cached = await self.cache.get(self.stack_key(cache_key))
+        return json.loads(cached) if cached else {"steps": [], "position": 0}
+
+    async def save(self, cache_key: str, stack: dict, layer, data_version: str):
+        # the active layer is also kept under `:filtered`, which is what the other endpoints read
+        if await self.data_version(cache_key) != data_version:
+            # the dataset was refilled while the layer was computed, and its stack cleared
+            logging.info(f"Filter stack for {cache_key}: dataset changed, layer not saved")
+            return
+        await self.cache.set(self.stack_key(cache_key), json.dumps(stack), expire=self.expire)
+        if layer is None:
+            await self.cache.delete(f"{cache_key}:filtered")
+            await self.cache.delete(self.version_key(cache_key))
+        else:
+            await self.cache.set_frame(f"{cache_key}:filtered", layer, expire=self.expire)
+            # the hash of the active steps identifies the layer, results derived from it are keyed by this
+            version = self.layer_hashes(stack["steps"][:stack["position"]], data_version)[-1]
+            await self.cache.set(self.version_key(cache_key), version, expire=self.expire)
+
+    async def clear(self, cache_key: str):
+        await self.cache.delete(self.stack_key(cache_key))
+        await self.cache.delete(f"{cache_key}:filtered")
+        await self.cache.delete(self.version_key(cache_key))
+
+    async def version(self, cache_key: str):
+        """Version of the `:filtered` layer, None when no filter is applied."""
+        return await self.cache.get(self.version_key(cache_key))
+
+    @staticmethod
+    def layer_hashes(steps, seed: str = ""):
+        hashes = []
+        parent = seed
+        for step in steps:
+            parent = hashlib.sha1((parent + json.dumps(step, sort_keys=True)).encode("utf-8")).hexdigest()
+            hashes.append(parent)
+        return hashes
+
+    @staticmethod
+    def push(stack: dict, step: dict) -> dict:
+        steps = stack["steps"][:stack["position"]] + [step]
+        return {"steps": steps, "position": len(steps)}
+
+    @staticmethod
+    def edit(stack: dict, index: int, step: dict) -> dict:
+        if not 0 <= index < stack["position"]:
+            raise IndexError(f"No active filter step at index {index}")
+        steps = list(stack["steps"])
+        steps[index] = step
+        # steps after the edited one are kept and re-applied, redo history past the position is dropped
+        steps = steps[:stack["position"]]
+        return {"steps": steps, "position": len(steps)}
+
+    @staticmethod
+    def move(stack: dict, offset: int) -> dict:
+        position = min(max(stack["position"] + offset, 0), len(stack["steps"]))
+        return {"steps": stack["steps"], "position": position}
+
+    async def materialize(self, cache_key: str, read_base, columns, stack: dict, data_version: str, sketches=None):
+        """
+        Return the active layer for the stack (None without steps), computing only uncached layers.
+        Steps run in a worker thread that reads the base through read_base, see apply_step().
+        `data_version` is the write being read, see data_version().
+        """
+        steps = stack["steps"][:stack["position"]]
+        if not steps:
+            return None
+
+        hashes = self.layer_hashes(steps, data_version)
+        layer_keys = [self.layer_key(cache_key, h) for h in hashes]
+        cached = await self.cache.exists_many(*layer_keys)
+
+        start = 0
+        layer = None
+        for i in range(len(steps) - 1, -1, -1):
+            if cached[i]:
+                layer = await self.cache.get_frame(layer_keys[i])
+                if layer is not None:
+                    start = i + 1
+                    break
+
+        logging.info(f"Filter stack for {cache_key}: reusing {start} of {len(steps)} layers")
+        for i in range(start, len(steps)):
+            layer = await asyncio.to_thread(apply_step, read_base, columns, layer, steps[i], sketches)
+            await self.cache.set_frame(layer_keys[i], layer, expire=self.expire)
+        return layer
@@ -0,0 +1,73 @@
+import numpy as np
+from filter import ROW_COLUMN, layer_overrides
+
+DEFAULT_BINS = 30
+
+
+def histogram_edges(low: float, high: float, bins: int = DEFAULT_BINS) -> np.ndarray:
+    # same convention as np.histogram for a constant or empty column
+    if not np.isfinite(low) or not np.isfinite(high):
+        low, high = 0.0, 1.0
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1)
+
+
+class StreamingHistogram:
+    """Counts over fixed edges, accumulated chunk by chunk in O(bins) memory. NaNs are skipped."""
+
+    def __init__(self, edges: np.ndarray):
+        self.edges = edges
+        self.counts = np.zeros(len(edges) - 1, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.counts += np.histogram(values, bins=self.edges)[0]
+        return self
+
+
+def column_ranges(batches, columns):
+    """(min, max) per column in one pass over the batches, for datasets without sketches."""
+    low = {col: np.inf for col in columns}
+    high = {col: -np.inf for col in columns}
+    for batch in batches:
+        for col in columns:
+            values = np.asarray(batch[col], dtype=float)
+            if len(values) and not np.isnan(values).all():
+                low[col] = min(low[col], np.nanmin(values))
+                high[col] = max(high[col], np.nanmax(values))
+    return {col: (low[col], high[col]) for col in columns}
+
+
+def shared_edges(ranges: dict, bins: int = DEFAULT_BINS) -> dict:
+    return {col: histogram_edges(low, high, bins) for col, (low, high) in ranges.items()}
+
+
+def accumulate_histograms(batches, columns, edges: dict, layer=None):
+    """
+    Histograms of the base dataset and of its filter layer in a single pass over the base batches
+    ({column: array} per record batch). Layer rows are ascending base positions, so each batch only
+    looks at the layer rows that fall inside it; smoothed columns are read from the layer itself.
+    Returns ({column: StreamingHistogram}, same for the layer or None).
+    """
+    full = {col: StreamingHistogram(edges[col]) for col in columns}
+    filtered = {col: StreamingHistogram(edges[col]) for col in columns} if layer is not None else None
+    if layer is not None:
+        rows = layer[ROW_COLUMN].to_numpy()
+        overrides = {col: layer[col].to_numpy() for col in layer_overrides(layer) if col in columns}
+
+    start = 0
+    for batch in batches:
+        size = len(batch[columns[0]]) if columns else 0
+        if layer is not None:
+            lo, hi = np.searchsorted(rows, [start, start + size])
+            selected = rows[lo:hi] - start
+        for col in columns:
+            values = batch[col]
+            full[col].add(values)
+            if layer is not None:
+                filtered[col].add(overrides[col][lo:hi] if col in overrides else np.asarray(values)[selected])
+        start += size
+    return full, filtered
@@ -1,16 +1,31 @@
-from fastapi import FastAPI, HTTPException, Query, Body
+from fastapi import FastAPI, HTTPException, Query, Body, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 from db_influx import InfluxDBHandler
 from cache_redis import RedisCache
-from model import ReadingData, AlgorithmModel
-from filter import DataFilter
-from plot import BokehPlotter
+from segment_cache import SegmentCache
+from extent_index import TimeExtentIndex
+from singleflight import SingleFlight
+from pagination import PagedStore, encode_cursor, decode_cursor
+from pyramid import PyramidStore
+from sketch import build_sketches, sketches_to_json, sketches_from_json
+from model import ReadingData, BatchReadingData, AlgorithmModel
+from filter import ROW_COLUMN, apply_filter_layer, layer_overrides
+from filter_stack import FilterStack
+from plot import PlotRenderPool, RenderQueueFull, encode_array
+from histogram import column_ranges, shared_edges, accumulate_histograms
 from map import FoliumPlotter
 from agent import DataAnalysisAgent
+from influxdb_client.client.exceptions import InfluxDBError
+from urllib3.exceptions import HTTPError as UrllibHTTPError
+import pandas as pd
+import numpy as np
+import asyncio
 import json
 import os
+import time
 import requests
 import logging
 from dotenv import load_dotenv
@@ -22,8 +37,41 @@ INFLUXDB_URL = os.getenv("INFLUXDB_URL")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG = os.getenv("INFLUXDB_ORG")
 INFLUXDB_BUCKET = "hkcodeplayground"
-
-app = FastAPI()
+INFLUXDB_MAX_CONCURRENCY = int(os.getenv("INFLUXDB_MAX_CONCURRENCY", 4))
+INFLUXDB_QUERY_TIMEOUT = float(os.getenv("INFLUXDB_QUERY_TIMEOUT", 120))
+# ranges longer than INFLUXDB_SHARD_MIN_HOURS are fetched as INFLUXDB_SHARDS parallel windows
+INFLUXDB_SHARDS = int(os.getenv("INFLUXDB_SHARDS", 4))
+INFLUXDB_SHARD_MIN_HOURS = float(os.getenv("INFLUXDB_SHARD_MIN_HOURS", 6))
+SEGMENT_BUCKET_SECONDS = int(os.getenv("SEGMENT_BUCKET_SECONDS", 3600))
+# a bucket is cached as complete only this long after it ends, rows can reach InfluxDB late
+SEGMENT_GRACE_SECONDS = int(os.getenv("SEGMENT_GRACE_SECONDS", 600))
+# points per column sent for a line plot, spikes are kept by the min/max downsampling
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", 2400))
+# relative accuracy of the per-column quantile sketches, 0 disables them
+SKETCH_ACCURACY = float(os.getenv("SKETCH_ACCURACY", 0.01))
+# plot renders run in worker processes, at most PLOT_RENDER_QUEUE are admitted at a time
+PLOT_RENDER_WORKERS = int(os.getenv("PLOT_RENDER_WORKERS", 2))
+PLOT_RENDER_QUEUE = int(os.getenv("PLOT_RENDER_QUEUE", 8))
+PLOT_RENDER_PROCESSES = os.getenv("PLOT_RENDER_PROCESSES", "1") == "1"
+# live tail: seconds between InfluxDB polls and most rows pushed per message
+LIVE_POLL_SECONDS = float(os.getenv("LIVE_POLL_SECONDS", 1.0))
+LIVE_MAX_POINTS = int(os.getenv("LIVE_MAX_POINTS", 5000))
+# a tail starts at most this far back, and failed polls back off up to LIVE_MAX_BACKOFF_SECONDS
+LIVE_BACKFILL_SECONDS = float(os.getenv("LIVE_BACKFILL_SECONDS", 300))
+LIVE_MAX_BACKOFF_SECONDS = float(os.getenv("LIVE_MAX_BACKOFF_SECONDS", 30))
+# live polls run on their own pool of this many threads, apart from INFLUXDB_MAX_CONCURRENCY
+LIVE_MAX_CONCURRENCY = int(os.getenv("LIVE_MAX_CONCURRENCY", 2))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+
+@asynccontextmanager
+async def lifespan(app):
+    # start the plot workers before the first request needs them
+    await plot_renderer.warm_up()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,19 +81,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-influx_handler = InfluxDBHandler(INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG)
-redis_cache = RedisCache()
+influx_handler = InfluxDBHandler(
+    INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG,
+    max_concurrent_queries=INFLUXDB_MAX_CONCURRENCY, query_timeout=INFLUXDB_QUERY_TIMEOUT,
+    shard_workers=INFLUXDB_SHARDS, live_workers=LIVE_MAX_CONCURRENCY
+)
+redis_cache = RedisCache(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+extent_index = TimeExtentIndex(redis_cache, influx_handler)
+
+
+async def fetch_range(req_no, item_no, start_date, end_date):
+    if end_date - start_date > timedelta(hours=INFLUXDB_SHARD_MIN_HOURS):
+        df = await influx_handler.query_dataframe_sharded_async(
+            req_no, item_no, start_date, end_date, shards=INFLUXDB_SHARDS
+        )
+    else:
+        df = await influx_handler.query_dataframe_async(req_no, item_no, start_date, end_date)
+    await extent_index.observe(req_no, item_no.split(" ")[1], df)
+    return df
+
+
+segment_cache = SegmentCache(
+    redis_cache, fetch_range, bucket_seconds=SEGMENT_BUCKET_SECONDS, grace_seconds=SEGMENT_GRACE_SECONDS
+)
+single_flight = SingleFlight(redis_cache)
+filter_stack = FilterStack(redis_cache)
+paged_store = PagedStore(redis_cache)
+pyramid_store = PyramidStore(redis_cache, paged_store)
+plot_renderer = PlotRenderPool(PLOT_RENDER_WORKERS, PLOT_RENDER_QUEUE, processes=PLOT_RENDER_PROCESSES)
 logging.basicConfig(level=logging.INFO)
 
 
+async def get_working_frame(cache_key):
+    # the base dataset with the filter layer applied if there is one
+    base = await paged_store.frame(cache_key)
+    layer = await redis_cache.get_frame(f"{cache_key}:filtered")
+    if base is None or layer is None:
+        return base
+    return apply_filter_layer(base, layer)
+
+
+async def cache_dataset(cache_key, df, req_no, item_no):
+    # stored as row batches, so a page or a time window only reads the batches it covers
+    index = await paged_store.write(cache_key, df, seek='timestamp')
+    # plots cached for an earlier fill of the same key are keyed by another write id
+    await redis_cache.set(f"{cache_key}:data_version", index["id"])
+    # filter layers point at rows of the previous write
+    await filter_stack.clear(cache_key)
+    # where the dataset came from, so /live can keep tailing it
+    await redis_cache.set(f"{cache_key}:source", json.dumps({"req_no": req_no, "item_no": item_no}))
+    if SKETCH_ACCURACY > 0:
+        sketches = await asyncio.to_thread(build_sketches, df, SKETCH_ACCURACY)
+        await redis_cache.set(f"{cache_key}:sketch", json.dumps(sketches_to_json(sketches)))
+    await pyramid_store.build(cache_key, df)
+
+
+async def get_sketches(cache_key):
+    cached = await redis_cache.get(f"{cache_key}:sketch")
+    return sketches_from_json(json.loads(cached)) if cached else None
+
+
+def preview_rows(df, n=5):
+    # cached datasets keep `timestamp` as epoch nanoseconds, render it for the table viewer
+    head = df.head(n).copy()
+    if 'timestamp' in head.columns and pd.api.types.is_integer_dtype(head['timestamp']):
+        head['timestamp'] = pd.to_datetime(head['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    return json.loads(head.to_json(orient='records'))
+
+
 @app.post("/load_data", response_class=JSONResponse)
 async def load_data(req_no: str, item_no: str, start_date: str, end_date: str):
     try:
         start_date_dt = datetime.fromisoformat(start_date)
         end_date_dt = datetime.fromisoformat(end_date)
 
-        data = influx_handler.query_data_from_influxdb(req_no, item_no, start_date_dt, end_date_dt, limit=5)
+        data = await influx_handler.query_data_async(req_no, item_no, start_date_dt, end_date_dt, limit=5)
         limited_data = data
+    except asyncio.TimeoutError:
+        return JSONResponse(status_code=504, content={"error": "InfluxDB query timed out"})
     except Exception as e:
         print(f"Error loading data: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -54,17 +167,47 @@ async def load_data(req_no: str, item_no: str, start_date: str, end_date: str):
 @app.post('/full_data/', response_class=JSONResponse)
 async def read_data(body: ReadingData):
     cache_key = f"{body.item_no}_{body.start_date}_{body.end_date}"
-    cached_data = await redis_cache.get(cache_key)
-    if cached_data:
+    if await paged_store.exists(cache_key):
         print(f"Cache hit for key: {cache_key}")
         return {'cachekey': cache_key}
     
     try:
-        print(f"Cache miss for key: {cache_key}. Querying InfluxDB.")
-        result = influx_handler.query_data_from_influxdb(body.req_no, body.item_no, body.start_date, body.end_date)
-        await redis_cache.set(cache_key, json.dumps(result))
+        print(f"Cache miss for key: {cache_key}. Assembling from cached segments.")
+
+        async def load():
+            result = await segment_cache.get_range(body.req_no, body.item_no, body.start_date, body.end_date)
+            await cache_dataset(cache_key, result, body.req_no, body.item_no)
+            return True
+
+        async def loaded():
+            return True if await paged_store.exists(cache_key) else None
+
+        await single_flight.do(cache_key, load, ready=loaded)
         return {'cachekey': cache_key}
     
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="InfluxDB query timed out")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post('/batch_data/', response_class=JSONResponse)
+async def read_batch_data(body: BatchReadingData):
+    vehicles = list(dict.fromkeys((v.req_no, v.item_no) for v in body.vehicles))
+    cache_keys = {item_no: f"{item_no}_{body.start_date}_{body.end_date}" for _, item_no in vehicles}
+    cached = await paged_store.exists_many(*[cache_keys[item_no] for _, item_no in vehicles])
+    missing = [pair for pair, hit in zip(vehicles, cached) if not hit]
+
+    try:
+        if missing:
+            print(f"Batch cache miss for {len(missing)} of {len(vehicles)} vehicles. Querying InfluxDB.")
+            results = await influx_handler.query_dataframes_batch_async(missing, body.start_date, body.end_date)
+            for (req_no, item_no), df in results.items():
+                await extent_index.observe(req_no, item_no.split(" ")[1], df)
+                await cache_dataset(cache_keys[item_no], df, req_no, item_no)
+        return {'cachekeys': cache_keys}
+
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="InfluxDB query timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -72,25 +215,45 @@ async def read_data(body: ReadingData):
 async def get_first_last_time(req_no: str, veh_no: str):
     try:
         veh = veh_no.split(" ")[1]
-        start_timestamp, end_timestamp = influx_handler.query_first_last_time(req_no, veh)
-        return {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp}
+        extent = await extent_index.get(req_no, veh)
+        if extent is None:
+            raise HTTPException(status_code=404, detail="No data for this vehicle")
+        start_timestamp = pd.Timestamp(extent['first'], tz='UTC').to_pydatetime()
+        end_timestamp = pd.Timestamp(extent['last'], tz='UTC').to_pydatetime()
+        return {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp, "row_count": extent['count']}
     
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="InfluxDB query timed out")
     except Exception as e:
         print(f"Error getting first and last time: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/column_stats", response_class=JSONResponse)
+async def column_stats(cache_key: str = Query(...)):
+    sketches = await get_sketches(cache_key)
+    if sketches is None:
+        raise HTTPException(status_code=404, detail="No column statistics for this cache key")
+    return {
+        col: {
+            "count": sketch.count, "min": sketch.min, "max": sketch.max, "mean": sketch.mean(),
+            "q25": sketch.quantile(0.25), "median": sketch.quantile(0.5), "q75": sketch.quantile(0.75),
+            "skew": sketch.skew(), "relative_accuracy": sketch.relative_accuracy,
+        }
+        for col, sketch in sketches.items() if sketch.count > 0
+    }
+
 @app.get("/add_algorithm", response_class=JSONResponse)
 async def add_algorithm(cache_key: str = Query(...), algorithm_name: str = Query(...)):
     try:
-        cached_data = await redis_cache.get(cache_key)
-        if not cached_data:
+        df = await paged_store.frame(cache_key)
+        if df is None:
             raise HTTPException(status_code=404, detail="Cache key not found")
-        
-        data_list = json.loads(cached_data)
 
         if algorithm_name == "DSN":
-            AxValues = [item['x'] for item in data_list]
-            AyValues = [item['z'] for item in data_list]
+            AxValues = df['x'].tolist()
+            AyValues = df['z'].tolist()
         
             param = {
                 'Ax': AxValues,
@@ -107,95 +270,391 @@ async def add_algorithm(cache_key: str = Query(...), algorithm_name: str = Query
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def apply_filter_stack(cache_key, stack):
+    """Apply the stack and return the preview rows of the result."""
+    # read before the base, a refill in between then only makes the layer unusable, never mislabelled
+    data_version = await filter_stack.data_version(cache_key)
+    index = await paged_store.load_index(cache_key)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Cache key not found")
+
+    print("received data length: ", index["rows"])
+    # the steps read the base batch by batch in a worker thread, it is never loaded as a whole
+    read_base = paged_store.reader(cache_key, index, asyncio.get_running_loop())
+    layer = await filter_stack.materialize(
+        cache_key, read_base, index["columns"], stack, data_version, await get_sketches(cache_key)
+    )
+    if layer is None:
+        await filter_stack.save(cache_key, stack, layer, data_version)
+        preview = await paged_store.rows(cache_key, np.arange(min(5, index["rows"])))
+        if preview is None:
+            raise HTTPException(status_code=404, detail="Cache key not found")
+        return preview.to_pandas()
+
+    print("processed data length: ", len(layer))
+    if layer.empty:
+        raise HTTPException(status_code=404, detail="No data after filtering")
+
+    await filter_stack.save(cache_key, stack, layer, data_version)
+    # only the preview rows are read
+    head = layer.head(5)
+    preview = await paged_store.rows(cache_key, head[ROW_COLUMN].to_numpy())
+    if preview is None:
+        raise HTTPException(status_code=404, detail="Cache key not found")
+    preview = preview.to_pandas()
+    for col in layer_overrides(head):
+        preview[col] = head[col].to_numpy()
+    return preview
+
 @app.post("/filtering", response_class=JSONResponse)
 async def filtering(cache_key: str = Query(...), filter_parms: dict = Body(...)):
     try:
-        subcache_key = f"{cache_key}:filtered"
-        cached_data = await redis_cache.get(subcache_key)
+        stack = filter_stack.push(await filter_stack.load(cache_key), filter_parms['filterValues'])
+        filtered_df = await apply_filter_stack(cache_key, stack)
+        return JSONResponse(content={"filtered_data": preview_rows(filtered_df)})
 
-        if not cached_data:
-            cached_data = await redis_cache.get(cache_key)
-            if not cached_data:
-                raise HTTPException(status_code=404, detail="Cache key not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        data_list = json.loads(cached_data)
-        print("received data length: ", len(data_list))
-        filter = filter_parms['filterValues']['selectedFilter']
-        value = filter_parms['filterValues']['inputValue']
-        checkboxes = filter_parms['filterValues']['checkboxes']
-        column = filter_parms['filterValues']['header']
+@app.post("/filtering/expression", response_class=JSONResponse)
+async def filtering_expression(cache_key: str = Query(...), expression: str = Body(..., embed=True)):
+    try:
+        stack = filter_stack.push(await filter_stack.load(cache_key), {'expression': expression})
+        filtered_df = await apply_filter_stack(cache_key, stack)
+        return JSONResponse(content={"filtered_data": preview_rows(filtered_df)})
+
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        filterClass = DataFilter(
-            data=data_list, selected_filter=filter, input_value=value, checkboxes=checkboxes, column=column
-        )
-        filtered_df = filterClass.apply_filter()
-        print("processed data length: ", len(filtered_df))
-        if filtered_df.empty:
-            raise HTTPException(status_code=404, detail="No data after filtering")
-        
-        filtered_data_json = filtered_df.to_json(orient='records')
-        await redis_cache.set(subcache_key, filtered_data_json)
-        return JSONResponse(content={"filtered_data": json.loads(filtered_data_json)[:5]})
+@app.post("/filtering/edit", response_class=JSONResponse)
+async def edit_filtering(cache_key: str = Query(...), index: int = Query(...), filter_parms: dict = Body(...)):
+    try:
+        stack = filter_stack.edit(await filter_stack.load(cache_key), index, filter_parms['filterValues'])
+        filtered_df = await apply_filter_stack(cache_key, stack)
+        return JSONResponse(content={"filtered_data": preview_rows(filtered_df)})
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/filtering/undo", response_class=JSONResponse)
+async def undo_filtering(cache_key: str = Query(...)):
+    try:
+        stack = filter_stack.move(await filter_stack.load(cache_key), -1)
+        filtered_df = await apply_filter_stack(cache_key, stack)
+        return JSONResponse(content={"filtered_data": preview_rows(filtered_df), "position": stack["position"]})
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/filtering/redo", response_class=JSONResponse)
+async def redo_filtering(cache_key: str = Query(...)):
+    try:
+        stack = filter_stack.move(await filter_stack.load(cache_key), 1)
+        filtered_df = await apply_filter_stack(cache_key, stack)
+        return JSONResponse(content={"filtered_data": preview_rows(filtered_df), "position": stack["position"]})
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/filtering/stack", response_class=JSONResponse)
+async def get_filter_stack(cache_key: str = Query(...)):
+    return await filter_stack.load(cache_key)
+
 @app.post("/reset", response_class=JSONResponse)
 async def reset(cache_key: str = Query(...)):
     try:
-        subcache_key = f"{cache_key}:filtered"
-        await redis_cache.delete(subcache_key)
+        await filter_stack.clear(cache_key)
         print("resetting cache")
-        original_cached_data = await redis_cache.get(cache_key)
-        data = json.loads(original_cached_data)[:5]
+        result = await paged_store.read_page(cache_key, 0, 5)
+        if result is None:
+            raise HTTPException(status_code=404, detail="Cache key not found")
+        data = preview_rows(result[0])
         return JSONResponse(content={"reset_data": data})
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/plot")
-async def plot_data(columns: str = Query(...), cache_key: str = Query(...), plot: str = Query(...)):
+@app.get("/rows", response_class=JSONResponse)
+async def get_rows(cache_key: str = Query(...), offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=1000),
+                   cursor: str = Query(None), columns: str = Query(None), sort_by: str = Query(None),
+                   descending: bool = False, filtered: bool = True):
     try:
-        print(cache_key, plot, columns)
-        cached_data = await redis_cache.get(cache_key)
-        if cached_data is None:
+        if cursor:
+            # a cursor carries the position and the view it was issued for
+            state = decode_cursor(cursor)
+            offset, columns, sort_by = state["offset"], state["columns"], state["sort_by"]
+            descending, filtered = state["descending"], state["filtered"]
+
+        version = await filter_stack.version(cache_key) if filtered else None
+        result = await paged_store.read_page(
+            cache_key, offset, limit, columns=columns.split(",") if columns else None,
+            sort_by=sort_by, descending=descending, layer_version=version
+        )
+        if result is None:
             raise HTTPException(status_code=404, detail="Cache key not found")
+        page, total = result
+        next_offset = offset + len(page)
+        next_cursor = encode_cursor({
+            "offset": next_offset, "columns": columns, "sort_by": sort_by,
+            "descending": descending, "filtered": filtered,
+        }) if next_offset < total else None
+        return {"rows": preview_rows(page, n=len(page)), "total": total, "offset": offset, "next_cursor": next_cursor}
+
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        logging.info(f"Columns: {columns}, Plot: {plot}, Cache Key: {cache_key}")
-        full_data = json.loads(cached_data)
-        logging.info(f"Full data length: {len(full_data)}")
-
-        subcache_key = f"{cache_key}:filtered"
-        subcached_data = await redis_cache.get(subcache_key)
-        
-        plotter_full = BokehPlotter(full_data, plot, columns, "Full Data")
-        plot_json_full = plotter_full.get_plot_json()
-        logging.info(f"Full data plot from Bokeh: {plotter_full}")
-        
-        if subcached_data:
-            filter_data = json.loads(subcached_data)
-            logging.info(f"Filtered data length: {len(filter_data)}")
-            plotter_filter = BokehPlotter(filter_data, plot, columns, "Filtered Data")
-            plot_json_filter = plotter_filter.get_plot_json()
-        else:
-            plot_json_filter = None
-        
-        return {"full_data": plot_json_full, "filtered_data": plot_json_filter}
+def plot_cache_key(cache_key, data_version, version, plot, columns):
+    return f"{cache_key}:plot:{data_version}:{version}:{plot}:{columns}"
+
+async def line_plots(cache_key, plot, columns, cached_full=None):
+    # only the plotted columns are read
+    plotted = ['timestamp'] + [col for col in columns.split(",") if col != 'timestamp']
+    full_data = await paged_store.frame(cache_key, plotted)
+    if full_data is None:
+        raise HTTPException(status_code=404, detail="Cache key not found")
+    layer = await redis_cache.get_frame(f"{cache_key}:filtered")
+    filter_data = apply_filter_layer(full_data, layer) if layer is not None else None
+
+    logging.info(f"Columns: {columns}, Plot: {plot}, Cache Key: {cache_key}")
+    logging.info(f"Full data length: {len(full_data)}")
+
+    async def render_full():
+        if cached_full:
+            return json.loads(cached_full)
+        return await plot_renderer.render(full_data, plot, columns, "Full Data", max_points=PLOT_MAX_POINTS)
+
+    async def render_filtered():
+        if filter_data is None:
+            return None
+        logging.info(f"Filtered data length: {len(filter_data)}")
+        return await plot_renderer.render(filter_data, plot, columns, "Filtered Data", max_points=PLOT_MAX_POINTS)
+
+    return await asyncio.gather(render_full(), render_filtered())
+
+async def histogram_plots(cache_key, columns, cached_full=None):
+    # both histograms share the edges of the base data and come from one pass over its record batches
+    layer = await redis_cache.get_frame(f"{cache_key}:filtered")
+    index = await paged_store.load_index(cache_key)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Cache key not found")
+    unknown = [col for col in columns if col not in index["columns"]]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+    # read in the worker thread, about STREAMING_CHUNK_SIZE rows of the plotted columns at a time
+    read = paged_store.reader(cache_key, index, asyncio.get_running_loop())
+    batches = ({col: table.column(col).to_numpy() for col in columns} for table in read(columns))
+    sketches = await get_sketches(cache_key)
+    if sketches is not None and all(col in sketches for col in columns):
+        ranges = {col: (sketches[col].min, sketches[col].max) for col in columns}
+    else:
+        # the ranges take their own pass, keep the decoded batches for the histogram pass
+        batches = await asyncio.to_thread(list, batches)
+        ranges = await asyncio.to_thread(column_ranges, batches, columns)
+
+    full, filtered = await asyncio.to_thread(accumulate_histograms, batches, columns, shared_edges(ranges), layer)
+
+    async def render_full():
+        if cached_full:
+            return json.loads(cached_full)
+        return await plot_renderer.render_histograms(full, "Full Data")
+
+    async def render_filtered():
+        if filtered is None:
+            return None
+        return await plot_renderer.render_histograms(filtered, "Filtered Data")
+
+    return await asyncio.gather(render_full(), render_filtered())
+
+async def plot_versions(cache_key):
+    """(dataset write, filter layer version) the plots of a dataset are keyed by, see plot_cache_key()."""
+    return await redis_cache.get(f"{cache_key}:data_version"), await filter_stack.version(cache_key)
+
+async def cached_plots(cache_key, data_version, version, plot, columns):
+    """(full key, filtered key, cached figures) for the given view of the dataset."""
+    # the full plot only depends on the dataset write, the filtered one also on the filter layer version
+    full_key = plot_cache_key(cache_key, data_version, "base", plot, columns)
+    filtered_key = plot_cache_key(cache_key, data_version, version, plot, columns) if version else None
+    cached = await redis_cache.get_many(*[key for key in (full_key, filtered_key) if key])
+    return full_key, filtered_key, cached
+
+def cached_plot_response(version, cached):
+    return {"full_data": json.loads(cached[0]), "filtered_data": json.loads(cached[1]) if version else None}
 
+@app.post("/plot")
+async def plot_data(columns: str = Query(...), cache_key: str = Query(...), plot: str = Query(...)):
+    try:
+        print(cache_key, plot, columns)
+        # read once up front: requests for different writes or filter versions must not share a render
+        data_version, version = await plot_versions(cache_key)
+
+        async def render():
+            full_key, filtered_key, cached = await cached_plots(cache_key, data_version, version, plot, columns)
+            if all(cached):
+                logging.info(f"Plot cache hit for {cache_key}, version {version}")
+                return cached_plot_response(version, cached)
+
+            if plot == 'bar':
+                plot_json_full, plot_json_filter = await histogram_plots(cache_key, columns.split(","), cached[0])
+            else:
+                plot_json_full, plot_json_filter = await line_plots(cache_key, plot, columns, cached[0])
+
+            # a refill or filter applied while rendering changes the versions, the plot is then only returned
+            current_data_version, current_version = await plot_versions(cache_key)
+            if not cached[0] and current_data_version == data_version:
+                await redis_cache.set(full_key, json.dumps(plot_json_full))
+            unchanged = (current_data_version, current_version) == (data_version, version)
+            if plot_json_filter is not None and version and unchanged:
+                await redis_cache.set(filtered_key, json.dumps(plot_json_filter))
+            return {"full_data": plot_json_full, "filtered_data": plot_json_filter}
+
+        async def rendered():
+            # another worker may have rendered this view while we waited for the lock
+            _, _, cached = await cached_plots(cache_key, data_version, version, plot, columns)
+            return cached_plot_response(version, cached) if all(cached) else None
+
+        flight_key = f"plot:{cache_key}:{data_version}:{version or 'base'}:{plot}:{columns}"
+        return await single_flight.do(flight_key, render, ready=rendered)
+
+    except HTTPException:
+        raise
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logging.error(f"Error generating plot: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/plot_range", response_class=JSONResponse)
+async def plot_range(cache_key: str = Query(...), columns: str = Query(...), t0: float = Query(...),
+                     t1: float = Query(...), width: int = Query(..., ge=1, le=20000)):
+    # t0 / t1 are epoch milliseconds, as reported by a Bokeh datetime range
+    try:
+        meta = await pyramid_store.load_meta(cache_key)
+        if meta is None:
+            raise HTTPException(status_code=404, detail="Cache key not found")
+        result = await pyramid_store.window(
+            cache_key, meta, columns.split(","), int(t0 * 1_000_000), int(t1 * 1_000_000), width
+        )
+        if result is None:
+            raise HTTPException(status_code=404, detail="Cache key not found")
+        level, bucket_size, timestamps, series = result
+        # timestamps are epoch ms, the unit of a Bokeh datetime axis
+        return {
+            "level": level,
+            "bucket_size": bucket_size,
+            "timestamp": encode_array(timestamps.to_numpy() / 1_000_000),
+            "columns": {
+                col: {stat: encode_array(values.to_numpy(dtype=float)) for stat, values in stats.items()}
+                for col, stats in series.items()
+            },
+        }
+
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def observe_live(req_no, veh_no, timestamps):
+    await extent_index.observe(req_no, veh_no, pd.DataFrame({"timestamp": np.concatenate(timestamps)}))
+
+@app.websocket("/live")
+async def live_tail(websocket: WebSocket, cache_key: str, columns: str, since: float = None):
+    """
+    Push rows recorded after the cached dataset, at most LIVE_BACKFILL_SECONDS back (or after `since`,
+    epoch ms), as they arrive in InfluxDB: {"timestamp": epoch ms, column: values} per message as encode_array float64 arrays,
+    only new rows are queried.
+    """
+    await websocket.accept()
+    source = await redis_cache.get(f"{cache_key}:source")
+    if source is None:
+        await websocket.close(code=1008, reason="Cache key not found")
+        return
+    source = json.loads(source)
+    veh_no = source["item_no"].split(" ")[1]
+    columns = columns.split(",")
+
+    if since is not None:
+        last = int(since * 1_000_000)
+    else:
+        # an old dataset is not replayed from its end, only the recent window is
+        meta = await pyramid_store.load_meta(cache_key)
+        window_start = pd.Timestamp.now(tz="UTC").value - int(LIVE_BACKFILL_SECONDS * 1_000_000_000)
+        last = max(meta["last"] if meta and meta["rows"] else 0, window_start)
+
+    failures = 0
+    # timestamps pushed since the extent index was last extended, it is updated at most once per
+    # refresh_after seconds instead of on every message (an older entry is re-checked anyway)
+    pending = []
+    observed_at = time.monotonic()
+    try:
+        while True:
+            try:
+                df = await influx_handler.query_since_async(source["req_no"], veh_no, last, limit=LIVE_MAX_POINTS)
+                failures = 0
+            except (asyncio.TimeoutError, InfluxDBError, UrllibHTTPError, OSError) as e:
+                failures += 1
+                logging.warning(f"Live tail query for {cache_key} failed ({failures} in a row), backing off: {e}")
+                df = pd.DataFrame(columns=["timestamp"])
+
+            if not df.empty:
+                last = int(df["timestamp"].iat[-1])
+                payload = {"timestamp": encode_array(df["timestamp"].to_numpy() / 1_000_000)}
+                for col in columns:
+                    if col in df.columns:
+                        payload[col] = encode_array(df[col].to_numpy(dtype=float))
+                await websocket.send_json(payload)
+                pending.append(df["timestamp"].to_numpy())
+
+            if pending and time.monotonic() - observed_at >= extent_index.refresh_after:
+                await observe_live(source["req_no"], veh_no, pending)
+                pending, observed_at = [], time.monotonic()
+
+            if len(df) < LIVE_MAX_POINTS:
+                # waiting on the socket instead of sleeping notices a closed client right away
+                try:
+                    delay = min(LIVE_POLL_SECONDS * 2 ** failures, LIVE_MAX_BACKOFF_SECONDS)
+                    await asyncio.wait_for(websocket.receive_text(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    except WebSocketDisconnect:
+        logging.info(f"Live tail for {cache_key} closed")
+    finally:
+        if pending:
+            await observe_live(source["req_no"], veh_no, pending)
+
 @app.post("/map")
 async def plot_map(cache_key: str = Query(...), lat: str = Query(...), lon: str = Query(...)):
     try:
-        cached_data = await redis_cache.get(cache_key)
-        if cached_data is None:
-            raise HTTPException(status_code=404, detail="Cache key not found")
+        data_version = await redis_cache.get(f"{cache_key}:data_version")
+        map_key = f"{cache_key}:map:{data_version}:{lat}:{lon}"
+
+        async def render():
+            cached = await redis_cache.get(map_key)
+            if cached:
+                return cached
+            data = await paged_store.frame(cache_key, [lat, lon])
+            if data is None:
+                raise HTTPException(status_code=404, detail="Cache key not found")
+
+            plotter = FoliumPlotter(data, lat, lon)
+            html = plotter.heatmap_plot()
+            await redis_cache.set(map_key, html)
+            return html
 
-        data = json.loads(cached_data)
-        plotter = FoliumPlotter(data, lat, lon)
-        plot_html = plotter.heatmap_plot()
+        async def rendered():
+            return await redis_cache.get(map_key)
+
+        plot_html = await single_flight.do(f"map:{cache_key}:{data_version}:{lat}:{lon}", render, ready=rendered)
 
         return JSONResponse(content={"heatmap": plot_html})
 
@@ -213,15 +672,16 @@ async def ask_ai(cache_key: str = Query(...), query: str = Query(...), session_i
     try:
         # Check if the agent for this session_id already exists
         if session_id not in agent_store:
-            subcache_key = f"{cache_key}:filtered"
-            cached_data = await redis_cache.get(subcache_key)
+            data = await get_working_frame(cache_key)
+            if data is None:
+                raise HTTPException(status_code=404, detail="Cache key not found")
+            # cached frames are zero-copy views over read-only Arrow buffers, the agent's generated code may write to it
+            data = data.copy()
 
-            if cached_data is None:
-                cached_data = await redis_cache.get(cache_key)
-                if cached_data is None:
-                    raise HTTPException(status_code=404, detail="Cache key not found")
+            # the agent answers time questions, give it datetimes rather than epoch nanoseconds
+            if 'timestamp' in data.columns and pd.api.types.is_integer_dtype(data['timestamp']):
+                data['timestamp'] = pd.to_datetime(data['timestamp'], unit='ns')
 
-            data = json.loads(cached_data)
             # Initialize the DataAnalysisAgent and store it in the agent_store
             agent_store[session_id] = DataAnalysisAgent(data, session_id)
 
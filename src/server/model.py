@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
 
 from datetime import datetime
 
@@ -10,6 +10,15 @@ class ReadingData(BaseModel):
     end_date: datetime
     # limit: Optional[int] = None
 
+class VehicleRef(BaseModel):
+    req_no: str
+    item_no: str
+
+class BatchReadingData(BaseModel):
+    vehicles: List[VehicleRef]
+    start_date: datetime
+    end_date: datetime
+
 class AlgorithmModel(BaseModel):
     cache_key: str
     algorith_name: str
\ No newline at end of file
@@ -0,0 +1,295 @@
+from filter import ROW_COLUMN, STREAMING_CHUNK_SIZE
+from cache_redis import encode_table
+import pyarrow as pa
+import pyarrow.compute as pc
+import pandas as pd
+import numpy as np
+import asyncio
+import base64
+import json
+import uuid
+
+# rows per separately stored batch of a paged table, a page only fetches the batches holding its rows
+PAGE_BATCH_ROWS = 4096
+# wide tables get fewer rows per batch, so a batch stays far below the cache chunk size
+PAGE_BATCH_BYTES = 1024 * 1024
+# batches expire this long after their index, so a reader that found the index finds the batches
+BATCH_EXPIRE_MARGIN = 60
+
+
+def encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+
+def contiguous(positions: np.ndarray) -> bool:
+    return len(positions) > 0 and bool(np.all(np.diff(positions) == 1))
+
+
+class PagedStore:
+    """
+    Tables stored as batches of at most PAGE_BATCH_ROWS rows under their own keys, plus a small
+    index, so reading a page costs the batches it covers rather than the whole table. Cached
+    datasets are stored only this way; derived tables (the filter layer) get a paged copy on
+    first use. Sorted views are stored the same way, per dataset write, layer, column and direction.
+    """
+
+    def __init__(self, cache, batch_rows: int = PAGE_BATCH_ROWS, expire: int = 4800):
+        self.cache = cache
+        self.batch_rows = batch_rows
+        self.expire = expire
+
+    def index_key(self, key: str) -> str:
+        return f"{key}:pages"
+
+    def batch_key(self, key: str, index: dict, i: int) -> str:
+        # batches carry the write id, so a reader never mixes batches of two writes
+        return f"{key}:page:{index['id']}:{i}"
+
+    def seek_key(self, key: str, index: dict) -> str:
+        return f"{key}:page:{index['id']}:seek"
+
+    async def load_index(self, key: str):
+        cached = await self.cache.get(self.index_key(key))
+        return json.loads(cached) if cached else None
+
+    async def exists(self, key: str) -> bool:
+        return await self.cache.exists(self.index_key(key))
+
+    async def exists_many(self, *keys):
+        return await self.cache.exists_many(*[self.index_key(key) for key in keys])
+
+    def rows_per_batch(self, table: pa.Table) -> int:
+        row_bytes = table.nbytes // table.num_rows if table.num_rows else 1
+        return max(min(self.batch_rows, PAGE_BATCH_BYTES // max(row_bytes, 1)), 1)
+
+    @staticmethod
+    def encode_batches(table: pa.Table, batch_rows: int):
+        # an empty table still gets one batch, it carries the schema
+        count = max(-(-table.num_rows // batch_rows), 1)
+        return [encode_table(table.slice(i * batch_rows, batch_rows)) for i in range(count)]
+
+    async def write(self, key: str, table, tag=None, seek=None) -> dict:
+        """
+        Store `table` under `key`, replacing any previous write. With `seek`, the first value of
+        that (ascending) column in every batch is kept as well, see locate().
+        """
+        if isinstance(table, pd.DataFrame):
+            table = await asyncio.to_thread(pa.Table.from_pandas, table, preserve_index=False)
+        previous = await self.load_index(key)
+        batch_rows = self.rows_per_batch(table)
+        payloads = await asyncio.to_thread(self.encode_batches, table, batch_rows)
+        index = {
+            "id": uuid.uuid4().hex, "tag": tag, "rows": table.num_rows, "batch_rows": batch_rows,
+            "batches": len(payloads), "columns": table.column_names,
+            "seek": seek if seek in table.column_names else None,
+        }
+        items = [(self.batch_key(key, index, i), payload) for i, payload in enumerate(payloads)]
+        if index["seek"]:
+            starts = table.column(seek).take(pa.array(np.arange(0, table.num_rows, batch_rows)))
+            items.append((self.seek_key(key, index), json.dumps(starts.to_pylist())))
+        await self.cache.set_many(items, expire=self.expire + BATCH_EXPIRE_MARGIN)
+        await self.cache.set(self.index_key(key), json.dumps(index), expire=self.expire)
+        if previous is not None:
+            await self.delete_batches(key, previous)
+        return index
+
+    async def delete_batches(self, key: str, index: dict):
+        keys = [self.batch_key(key, index, i) for i in range(index["batches"])]
+        if index.get("seek"):
+            keys.append(self.seek_key(key, index))
+        await self.cache.delete_many(*keys)
+
+    async def ensure(self, key: str, tag=None):
+        """
+        Index of the paged table `key`. A derived table cached as a single value is paged on first
+        use, and again when its tag changes. None if there is neither.
+        """
+        index = await self.load_index(key)
+        if index is not None and index.get("tag") == tag:
+            return index
+        table = (await self.cache.get_tables(key))[0]
+        if table is None:
+            return None
+        return await self.write(key, table, tag)
+
+    async def read_batches(self, key: str, index: dict, batch_ids, columns=None):
+        """The given batches as Arrow tables, None if any of them has expired or was replaced."""
+        tables = await self.cache.get_tables(*[self.batch_key(key, index, int(i)) for i in batch_ids])
+        if any(table is None for table in tables):
+            return None
+        return [table.select(columns) for table in tables] if columns is not None else tables
+
+    @staticmethod
+    def assemble(tables, needed, positions, batch_rows):
+        if contiguous(positions):
+            start = int(positions[0]) - int(needed[0]) * batch_rows
+            return pa.concat_tables(tables).slice(start, len(positions))
+        starts = np.concatenate([[0], np.cumsum([table.num_rows for table in tables])[:-1]])
+        local = starts[np.searchsorted(needed, positions // batch_rows)] + positions % batch_rows
+        return pa.concat_tables(tables).take(pa.array(local, type=pa.int64()))
+
+    async def take(self, key: str, index: dict, positions, columns=None):
+        """Rows at `positions`, in that order, as an Arrow table. None if a batch has expired."""
+        positions = np.asarray(positions, dtype=np.int64)
+        needed = np.unique(positions // index["batch_rows"]) if len(positions) else np.array([0])
+        tables = await self.read_batches(key, index, needed, columns)
+        if tables is None:
+            return None
+        if len(positions) >= index["batch_rows"]:
+            return await asyncio.to_thread(self.assemble, tables, needed, positions, index["batch_rows"])
+        return self.assemble(tables, needed, positions, index["batch_rows"])
+
+    async def rows(self, key: str, positions, columns=None, tag=None):
+        index = await self.ensure(key, tag)
+        if index is None:
+            return None
+        table = await self.take(key, index, positions, columns)
+        if table is None:
+            current = await self.load_index(key)
+            if current is not None and current["id"] == index["id"]:
+                # a batch expired or was evicted before its index, rebuild the copy once if possible
+                await self.cache.delete(self.index_key(key))
+            # otherwise a newer write replaced the batches, read that one
+            index = await self.ensure(key, tag)
+            table = await self.take(key, index, positions, columns) if index is not None else None
+        return table
+
+    async def table(self, key: str, columns=None, tag=None):
+        index = await self.ensure(key, tag)
+        if index is None:
+            return None
+        return await self.rows(key, np.arange(index["rows"]), columns, tag)
+
+    async def frame(self, key: str, columns=None):
+        """The whole table as a DataFrame, only `columns` if given. None if it is not cached."""
+        table = await self.table(key, columns)
+        if table is None:
+            return None
+        return await asyncio.to_thread(table.to_pandas)
+
+    async def locate(self, key: str, column: str, values):
+        """
+        np.searchsorted(column, values, side='left') over the whole ascending `column`, reading
+        only the seek index and the batches the values fall in. None if the table is not cached.
+        """
+        index = await self.load_index(key)
+        if index is None:
+            return None
+        if index.get("seek") != column:
+            raise ValueError(f"{key} has no seek index on {column}")
+        starts = await self.cache.get(self.seek_key(key, index))
+        if starts is None:
+            return None
+        # the first row >= v is in the last batch starting below v, or is the first row of the next
+        batch_ids = np.maximum(np.searchsorted(np.asarray(json.loads(starts)), values, side='left') - 1, 0)
+        tables = await self.read_batches(key, index, np.unique(batch_ids), [column])
+        if tables is None:
+            return None
+        by_batch = {int(i): table.column(column).to_numpy() for i, table in zip(np.unique(batch_ids), tables)}
+        return [
+            int(i) * index["batch_rows"] + int(np.searchsorted(by_batch[int(i)], value, side='left'))
+            for i, value in zip(batch_ids, values)
+        ]
+
+    def reader(self, key: str, index: dict, loop, rows_per_read: int = STREAMING_CHUNK_SIZE):
+        """
+        read(columns) for code running in a worker thread: yields the table in order as Arrow
+        tables of about `rows_per_read` rows. Each read is awaited on `loop`, so memory stays at
+        one read regardless of the table size.
+        """
+        per_read = max(rows_per_read // index["batch_rows"], 1)
+
+        def read(columns):
+            for first in range(0, index["batches"], per_read):
+                batch_ids = range(first, min(first + per_read, index["batches"]))
+                tables = asyncio.run_coroutine_threadsafe(
+                    self.read_batches(key, index, batch_ids, columns), loop
+                ).result()
+                if tables is None:
+                    raise KeyError(f"{key} expired or was replaced while it was being read")
+                yield pa.concat_tables(tables)
+
+        return read
+
+    async def view(self, cache_key: str, layer_key=None, layer_version=None) -> pa.Table:
+        """The whole dataset, or its filtered rows with smoothed columns applied, as one Arrow table."""
+        if layer_key is None:
+            return await self.table(cache_key)
+        layer = await self.table(layer_key, tag=layer_version)
+        if layer is None:
+            return None
+        table = await self.rows(cache_key, layer.column(ROW_COLUMN).to_numpy())
+        if table is None:
+            return None
+        for col in set(layer.column_names) - {ROW_COLUMN}:
+            table = table.set_column(table.schema.get_field_index(col), col, layer.column(col))
+        return table
+
+    async def sorted_view(self, cache_key, base_index, layer_key, layer_version, sort_by, descending):
+        """
+        Key of a paged copy of the view in sorted order. It is built once per dataset write, layer,
+        column and direction (the only step that reads the whole view), after that a sorted page is
+        a range read like any other. None if the dataset or layer expired.
+        """
+        key = (
+            f"{cache_key}:sorted:{base_index['id']}:{layer_version or 'base'}:{sort_by}:"
+            f"{'desc' if descending else 'asc'}"
+        )
+        if await self.ensure(key) is None:
+            table = await self.view(cache_key, layer_key, layer_version)
+            if table is None:
+                return None
+            order = await asyncio.to_thread(
+                pc.array_sort_indices, table.column(sort_by), order="descending" if descending else "ascending"
+            )
+            await self.write(key, await asyncio.to_thread(table.take, order))
+        return key
+
+    async def read_page(self, cache_key: str, offset: int, limit: int, columns=None, sort_by=None, descending=False,
+                        layer_version=None):
+        """
+        One page of the dataset, or of its filter layer when `layer_version` is given, as a DataFrame
+        plus the total row count. None if the dataset is not cached.
+        """
+        base_index = await self.load_index(cache_key)
+        if base_index is None:
+            return None
+        columns = columns or base_index["columns"]
+        missing = [c for c in columns + ([sort_by] if sort_by else []) if c not in base_index["columns"]]
+        if missing:
+            raise ValueError(f"Unknown columns: {', '.join(missing)}")
+
+        layer_key = f"{cache_key}:filtered" if layer_version else None
+        layer_index = await self.ensure(layer_key, layer_version) if layer_key else None
+        if layer_index is None:
+            layer_key = layer_version = None
+        total = layer_index["rows"] if layer_index is not None else base_index["rows"]
+        positions = np.arange(min(offset, total), min(offset + limit, total))
+
+        if sort_by:
+            key = await self.sorted_view(cache_key, base_index, layer_key, layer_version, sort_by, descending)
+            page = await self.rows(key, positions, columns) if key is not None else None
+            return (page.to_pandas(), total) if page is not None else None
+
+        if layer_index is None:
+            page = await self.rows(cache_key, positions, columns)
+            return (page.to_pandas(), total) if page is not None else None
+
+        overrides = [c for c in layer_index["columns"] if c != ROW_COLUMN and c in columns]
+        layer_rows = await self.rows(layer_key, positions, [ROW_COLUMN] + overrides, layer_version)
+        if layer_rows is None:
+            return None
+        page = await self.rows(cache_key, layer_rows.column(ROW_COLUMN).to_numpy(), columns)
+        if page is None:
+            return None
+        page = page.to_pandas()
+        for col in overrides:
+            page[col] = layer_rows.column(col).to_numpy(zero_copy_only=False)
+        return page, total
@@ -2,15 +2,77 @@ from bokeh.plotting import figure, show
 from bokeh.embed import json_item
 from bokeh.palettes import Category10
 from bokeh.models import DatetimeTickFormatter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import pandas as pd
 import numpy as np
+import base64
+import functools
+import asyncio
 import logging
 import traceback
+from histogram import StreamingHistogram, shared_edges
+
+# figures are 600px wide, first/min/max/last per pixel column keeps every spike visible
+DEFAULT_MAX_POINTS = 2400
+
+
+def minmax_downsample(values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Indices of the points to draw: the first, last, minimum and maximum sample of each of
+    max_points / 4 equal buckets, in their original order. Returns all indices if the series
+    is already small enough.
+    """
+    n = len(values)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+
+    values = np.asarray(values, dtype=float)
+    n_buckets = max(max_points // 4, 1)
+    edges = np.linspace(0, n, n_buckets + 1).astype(np.int64)[:-1]
+    bucket = np.repeat(np.arange(n_buckets), np.diff(np.append(edges, n)))
+
+    picks = [edges, np.append(edges[1:] - 1, n - 1)]
+    for reduce in (np.fmin, np.fmax):
+        extreme = reduce.reduceat(values, edges)
+        hits = np.flatnonzero(values == extreme[bucket])
+        # first hit per bucket, buckets that are all NaN have none
+        _, first = np.unique(bucket[hits], return_index=True)
+        picks.append(hits[first])
+    return np.unique(np.concatenate(picks))
+
+
+def plot_colors(num_columns):
+    if num_columns == 1:
+        return ["#3182CE"]
+    elif num_columns == 2:
+        return ["#3182CE", "#F56565"]
+    elif num_columns <= 10:
+        return Category10[num_columns]
+    else:
+        raise ValueError(f"Too many columns to plot, max supported is 10")
+
+
+def encode_array(values, dtype: str = "float64") -> dict:
+    """
+    Typed array in Bokeh's ndarray wire format (little endian, base64), the same encoding json_item
+    uses for ColumnDataSource columns. NaN survives as NaN, unlike in a JSON number list.
+    """
+    array = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {
+        "type": "ndarray",
+        "array": {"type": "bytes", "data": base64.b64encode(array.tobytes()).decode("ascii")},
+        "shape": [len(array)],
+        "dtype": dtype,
+        "order": "little",
+    }
+
 
 class BokehPlotter:
-    def __init__(self, data, plot_type, columns, typeof_data):
+    def __init__(self, data, plot_type, columns, typeof_data, max_points=DEFAULT_MAX_POINTS):
         try:
             self.data = data
+            self.max_points = max_points
             self.plot_type = plot_type
             self.columns = columns.split(",")
             self.df = pd.DataFrame(data)
@@ -34,57 +96,132 @@ class BokehPlotter:
             raise
 
     def _get_colors(self):
-        num_columns = len(self.columns)
-        if num_columns == 1:
-            return ["#3182CE"]
-        elif num_columns == 2:
-            return ["#3182CE", "#F56565"]
-        elif num_columns <= 10:
-            return Category10[num_columns]
-        else:
-            raise ValueError(f"Too many columns to plot, max supported is 10")
+        return plot_colors(len(self.columns))
 
     def line_plot(self):
         try:
-            p = figure(x_axis_type="datetime", title=f"Line Plot {self.typeof_data}", height=400, width=600)
-            p.xaxis.formatter = DatetimeTickFormatter(
-                hours="%m-%d %H:%M",
-                days="%m-%d %H:%M",
-                months="%m-%d %H:%M",
-                years="%m-%d %H:%M",
-            )
-            
-            colors = self._get_colors()
-            logging.info(f"Colors used for plotting: {colors}")
-            for idx, col in enumerate(self.columns):
-                p.line(self.df['timestamp'], self.df[col], legend_label=col, color=colors[idx])
-                # p.circle(self.df['timestamp'], self.df[col], legend_label=col, color=colors[idx], size=5)
-
-            p.legend.title = 'Data'
-            p.xaxis.axis_label = 'Timestamp'
-            p.yaxis.axis_label = 'Values'
-
-            return json_item(p)
+            return line_plot(downsample_series(self.df, self.columns, self.max_points), self.typeof_data)
         except Exception as e:
             logging.error(f"Error in line_plot: {e}")
             logging.error(traceback.format_exc())
             raise
 
-
     def bar_plot(self):
         try:
-            p = figure(title=f"Histogram of {self.typeof_data}", height=400, width=600)
-            colors = self._get_colors()
-            for idx, col in enumerate(self.columns):
-                hist, edges = np.histogram(self.df[col], bins=30)
-                p.quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:], fill_color=colors[idx], line_color="white", alpha=0.7, legend_label=col)
-
-            p.legend.title = 'Data'
-            p.xaxis.axis_label = 'Values'
-            p.yaxis.axis_label = 'Frequency'
-
-            return json_item(p)
+            ranges = {col: (self.df[col].min(), self.df[col].max()) for col in self.columns}
+            edges = shared_edges(ranges)
+            histograms = {col: StreamingHistogram(edges[col]).add(self.df[col].to_numpy()) for col in self.columns}
+            return histogram_plot(histograms, self.typeof_data)
         except Exception as e:
             logging.error(f"Error in bar_plot: {e}")
             logging.error(traceback.format_exc())
             raise
+
+
+def downsample_series(df: pd.DataFrame, columns, max_points=DEFAULT_MAX_POINTS):
+    """{column: (timestamps, values)} of the points to draw, see minmax_downsample()."""
+    timestamps = pd.to_datetime(df['timestamp']).to_numpy()
+    series = {}
+    for col in columns:
+        values = df[col].to_numpy()
+        keep = minmax_downsample(values, max_points)
+        series[col] = (timestamps[keep], values[keep])
+    return series
+
+
+def line_plot(series, typeof_data):
+    """Line plot from precomputed {column: (timestamps, values)}, drawn as given."""
+    p = figure(x_axis_type="datetime", title=f"Line Plot {typeof_data}", height=400, width=600)
+    p.xaxis.formatter = DatetimeTickFormatter(
+        hours="%m-%d %H:%M",
+        days="%m-%d %H:%M",
+        months="%m-%d %H:%M",
+        years="%m-%d %H:%M",
+    )
+
+    colors = plot_colors(len(series))
+    logging.info(f"Colors used for plotting: {colors}")
+    for idx, (col, (timestamps, values)) in enumerate(series.items()):
+        p.line(timestamps, values, legend_label=col, color=colors[idx], name=col)
+
+    p.legend.title = 'Data'
+    p.xaxis.axis_label = 'Timestamp'
+    p.yaxis.axis_label = 'Values'
+
+    return json_item(p)
+
+
+def histogram_plot(histograms, typeof_data):
+    """Bar plot from precomputed {column: StreamingHistogram}, the counts are all that is needed."""
+    p = figure(title=f"Histogram of {typeof_data}", height=400, width=600)
+    colors = plot_colors(len(histograms))
+    for idx, (col, histogram) in enumerate(histograms.items()):
+        edges = histogram.edges
+        p.quad(top=histogram.counts, bottom=0, left=edges[:-1], right=edges[1:], fill_color=colors[idx], line_color="white", alpha=0.7, legend_label=col)
+
+    p.legend.title = 'Data'
+    p.xaxis.axis_label = 'Values'
+    p.yaxis.axis_label = 'Frequency'
+
+    return json_item(p)
+
+
+def render_plot(data, plot_type, columns, typeof_data, max_points=DEFAULT_MAX_POINTS):
+    """Module level so it can run in a worker process."""
+    return BokehPlotter(data, plot_type, columns, typeof_data, max_points=max_points).get_plot_json()
+
+
+def worker_ready():
+    # importing this module in a worker loads Bokeh, so the first real render does not pay for it
+    return True
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class PlotRenderPool:
+    """
+    Renders plots off the event loop. Figure building is CPU bound Python, so by default each
+    render runs in a worker process and the full and filtered plots really do run in parallel.
+    At most `max_pending` renders are admitted at once (running or waiting for a worker); a request
+    that cannot get a slot within `queue_timeout` seconds raises RenderQueueFull.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8, queue_timeout: float = 30, processes: bool = True):
+        self.workers = workers
+        if processes:
+            # spawn, forking a server process that already runs threads is not safe
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plot-render")
+        self.slots = asyncio.Semaphore(max_pending)
+        self.queue_timeout = queue_timeout
+
+    async def warm_up(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.executor, worker_ready) for _ in range(self.workers)
+        ])
+
+    async def run(self, func, *args):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise RenderQueueFull("Too many plots are being rendered, try again shortly")
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+        finally:
+            self.slots.release()
+
+    async def render(self, data: pd.DataFrame, plot_type, columns, typeof_data, max_points=DEFAULT_MAX_POINTS):
+        if plot_type == 'line':
+            # downsampled here, so at most max_points points per column are sent to the worker
+            series = await asyncio.to_thread(downsample_series, data, columns.split(","), max_points)
+            return await self.run(line_plot, series, typeof_data)
+        # only the plotted columns are sent to the worker
+        data = data[['timestamp'] + [col for col in columns.split(",") if col != 'timestamp']]
+        return await self.run(render_plot, data, plot_type, columns, typeof_data, max_points)
+
+    async def render_histograms(self, histograms, typeof_data):
+        return await self.run(histogram_plot, histograms, typeof_data)
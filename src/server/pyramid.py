@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import asyncio
+import json
+
+# each level aggregates `PYRAMID_FACTOR` buckets of the level below, until fewer than PYRAMID_MIN_ROWS remain
+PYRAMID_FACTOR = 4
+PYRAMID_MIN_ROWS = 512
+
+
+def numeric_columns(df: pd.DataFrame):
+    return [
+        col for col in df.columns
+        if col != 'timestamp' and pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])
+    ]
+
+
+def aggregate_level(timestamps: np.ndarray, stats: dict, factor: int):
+    """Merge every `factor` consecutive buckets. `stats` maps column -> (min, max, sum, count) arrays."""
+    starts = np.arange(0, len(timestamps), factor)
+    merged = {}
+    for col, (mins, maxs, sums, counts) in stats.items():
+        merged[col] = (
+            np.fmin.reduceat(mins, starts),
+            np.fmax.reduceat(maxs, starts),
+            np.add.reduceat(sums, starts),
+            np.add.reduceat(counts, starts),
+        )
+    return timestamps[starts], merged
+
+
+def level_frame(timestamps, stats) -> pd.DataFrame:
+    data = {'timestamp': timestamps}
+    for col, (mins, maxs, sums, counts) in stats.items():
+        data[f'{col}_min'] = mins
+        data[f'{col}_max'] = maxs
+        data[f'{col}_sum'] = sums
+        data[f'{col}_count'] = counts
+    return pd.DataFrame(data)
+
+
+def build_pyramid(df: pd.DataFrame, factor: int = PYRAMID_FACTOR, min_rows: int = PYRAMID_MIN_ROWS):
+    """
+    Min/max/mean aggregates of every numeric column at resolutions of factor, factor^2, ... samples
+    per bucket. Each level is built from the one below, so the whole pyramid costs O(rows).
+    Returns a list of (bucket_size, frame), finest first; the raw data is level 0 and not included.
+    """
+    columns = numeric_columns(df)
+    timestamps = df['timestamp'].to_numpy()
+    stats = {}
+    for col in columns:
+        values = df[col].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        stats[col] = (values, values, np.where(valid, values, 0.0), valid.astype(np.int64))
+
+    levels = []
+    bucket_size = 1
+    while len(timestamps) > min_rows:
+        timestamps, stats = aggregate_level(timestamps, stats, factor)
+        bucket_size *= factor
+        levels.append((bucket_size, level_frame(timestamps, stats)))
+    return levels
+
+
+class PyramidStore:
+    """Stores a dataset's pyramid next to it in the cache and serves the right level for a zoom window."""
+
+    def __init__(self, cache, paged, expire: int = 4800):
+        self.cache = cache
+        # PagedStore holding the raw datasets, level 0
+        self.paged = paged
+        self.expire = expire
+
+    def meta_key(self, cache_key: str) -> str:
+        return f"{cache_key}:pyramid"
+
+    def level_key(self, cache_key: str, level: int) -> str:
+        return f"{cache_key}:pyramid:{level}"
+
+    async def load_meta(self, cache_key: str):
+        cached = await self.cache.get(self.meta_key(cache_key))
+        return json.loads(cached) if cached else None
+
+    async def build(self, cache_key: str, df: pd.DataFrame):
+        levels = await asyncio.to_thread(build_pyramid, df)
+        timestamps = df['timestamp'].to_numpy()
+        meta = {
+            'rows': len(df),
+            'first': int(timestamps[0]) if len(df) else 0,
+            'last': int(timestamps[-1]) if len(df) else 0,
+            'columns': numeric_columns(df),
+            'levels': [],
+        }
+        for level, (bucket_size, frame) in enumerate(levels, start=1):
+            await self.cache.set_frame(self.level_key(cache_key, level), frame, expire=self.expire)
+            meta['levels'].append({'level': level, 'bucket_size': bucket_size, 'rows': len(frame)})
+        await self.cache.set(self.meta_key(cache_key), json.dumps(meta), expire=self.expire)
+        return meta
+
+    @staticmethod
+    def choose_level(meta: dict, t0: int, t1: int, width: int) -> int:
+        """Coarsest level that still has at least one bucket per pixel in the window, 0 for the raw data."""
+        span = max(meta['last'] - meta['first'], 1)
+        fraction = min(max((t1 - t0) / span, 0.0), 1.0)
+        for level in reversed(meta['levels']):
+            if level['rows'] * fraction >= width:
+                return level['level']
+        return 0
+
+    async def window(self, cache_key: str, meta: dict, columns, t0: int, t1: int, width: int):
+        """
+        Return (level, bucket_size, timestamps, {column: {'min', 'max', 'mean'}}) for the samples in
+        [t0, t1). Below the finest level the raw rows are returned, min/max/mean are then the values.
+        """
+        unknown = [col for col in columns if col not in meta['columns']]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+        level = self.choose_level(meta, t0, t1, width)
+        if level == 0:
+            # only the batches holding the window are read
+            bounds = await self.paged.locate(cache_key, 'timestamp', [t0, t1])
+            if bounds is None:
+                return None
+            table = await self.paged.rows(cache_key, np.arange(*bounds), ['timestamp'] + list(columns))
+            if table is None:
+                return None
+            window = table.to_pandas()
+            series = {col: {'min': window[col], 'max': window[col], 'mean': window[col]} for col in columns}
+            return 0, 1, window['timestamp'], series
+
+        frame = await self.cache.get_frame(self.level_key(cache_key, level))
+        if frame is None:
+            return None
+        timestamps = frame['timestamp'].to_numpy()
+        # the bucket starting before t0 also covers part of the window
+        lo = max(int(np.searchsorted(timestamps, t0, side='right')) - 1, 0)
+        hi = np.searchsorted(timestamps, t1, side='left')
+        window = frame.iloc[lo:hi]
+        series = {}
+        for col in columns:
+            counts = window[f'{col}_count']
+            series[col] = {
+                'min': window[f'{col}_min'],
+                'max': window[f'{col}_max'],
+                'mean': window[f'{col}_sum'] / counts.where(counts > 0),
+            }
+        return level, meta['levels'][level - 1]['bucket_size'], window['timestamp'], series
@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import logging
+
+
+def to_epoch_ns(dt: datetime) -> int:
+    # naive datetimes are treated as UTC, like the Flux range in InfluxDBHandler.build_query
+    ts = pd.Timestamp(dt)
+    ts = ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+    return ts.value
+
+
+def from_epoch_ns(value: int) -> datetime:
+    return pd.Timestamp(value, tz='UTC').to_pydatetime()
+
+
+class SegmentCache:
+    """
+    Caches vehicle data per (req_no, veh_no) in fixed-size time buckets aligned to the epoch.
+    A requested range is served from the buckets already in Redis and only the missing
+    gaps are fetched from InfluxDB. A bucket is only cached once it ended more than
+    `grace_seconds` ago, so rows ingested late still land in it.
+    """
+
+    def __init__(self, cache, fetch_range, bucket_seconds: int = 3600, expire: int = 4800, grace_seconds: int = 600):
+        self.cache = cache
+        # async callable (req_no, item_no, start_date, end_date) -> DataFrame
+        self.fetch_range = fetch_range
+        self.bucket_ns = int(bucket_seconds) * 1_000_000_000
+        self.expire = expire
+        self.grace_ns = int(grace_seconds) * 1_000_000_000
+
+    def bucket_key(self, req_no: str, veh_no: str, bucket_start: int) -> str:
+        return f"seg:{req_no}:{veh_no}:{bucket_start // 1_000_000_000}"
+
+    def bucket_starts(self, start_ns: int, end_ns: int):
+        first = start_ns - start_ns % self.bucket_ns
+        return list(range(first, end_ns, self.bucket_ns))
+
+    async def get_range(self, req_no: str, item_no: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        veh_no = item_no.split(" ")[1]
+        start_ns, end_ns = to_epoch_ns(start_date), to_epoch_ns(end_date)
+        if end_ns <= start_ns:
+            return pd.DataFrame(columns=['timestamp'])
+
+        bucket_starts = self.bucket_starts(start_ns, end_ns)
+        frames = await self.cache.get_frames(*[self.bucket_key(req_no, veh_no, b) for b in bucket_starts])
+
+        buckets = {}
+        missing = []
+        for bucket_start, frame in zip(bucket_starts, frames):
+            if frame is None:
+                missing.append(bucket_start)
+            else:
+                buckets[bucket_start] = frame
+
+        logging.info(f"Segment cache {req_no}/{veh_no}: {len(buckets)} buckets cached, {len(missing)} missing")
+        for gap_start, gap_end in self._gaps(missing):
+            fetched = await self.fetch_range(req_no, item_no, from_epoch_ns(gap_start), from_epoch_ns(gap_end))
+            buckets.update(await self._store_buckets(req_no, veh_no, fetched, gap_start, gap_end))
+
+        frames = [buckets[key] for key in sorted(buckets) if not buckets[key].empty]
+        if not frames:
+            return pd.DataFrame(columns=['timestamp'])
+        df = pd.concat(frames, ignore_index=True, copy=False)
+
+        timestamps = df['timestamp'].to_numpy()
+        lo, hi = np.searchsorted(timestamps, [start_ns, end_ns], side='left')
+        return df.iloc[lo:hi].reset_index(drop=True)
+
+    def _gaps(self, missing):
+        # merge adjacent missing buckets so each gap is a single InfluxDB query
+        gaps = []
+        for bucket_start in missing:
+            if gaps and gaps[-1][1] == bucket_start:
+                gaps[-1][1] = bucket_start + self.bucket_ns
+            else:
+                gaps.append([bucket_start, bucket_start + self.bucket_ns])
+        return gaps
+
+    async def _store_buckets(self, req_no: str, veh_no: str, df: pd.DataFrame, gap_start: int, gap_end: int):
+        bounds = list(range(gap_start, gap_end + 1, self.bucket_ns))
+        if df.empty:
+            offsets = [0] * len(bounds)
+        else:
+            offsets = np.searchsorted(df['timestamp'].to_numpy(), bounds, side='left')
+
+        # buckets that are still being written to, or may still receive late rows, must not be cached as complete
+        complete_before = to_epoch_ns(datetime.now(timezone.utc)) - self.grace_ns
+        buckets = {}
+        for i, bucket_start in enumerate(bounds[:-1]):
+            frame = df.iloc[offsets[i]:offsets[i + 1]].reset_index(drop=True)
+            buckets[bucket_start] = frame
+            if bucket_start + self.bucket_ns <= complete_before:
+                await self.cache.set_frame(self.bucket_key(req_no, veh_no, bucket_start), frame, expire=self.expire)
+        return buckets
@@ -0,0 +1,54 @@
+from redis.exceptions import LockError
+import asyncio
+import logging
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight computation.
+    Callers inside a worker share one task. When `ready` is given, workers also
+    serialize on a Redis lock and re-check `ready` so only one of them computes.
+    """
+
+    def __init__(self, cache=None, lock_timeout: float = 300, wait_timeout: float = 300):
+        self.cache = cache
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.calls = {}
+
+    async def do(self, key: str, fn, ready=None):
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(self._run(key, fn, ready))
+            self.calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            logging.info(f"Joining in-flight call for key: {key}")
+        # shield so a disconnecting client does not cancel the call for everyone else
+        return await asyncio.shield(call)
+
+    def _forget(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    async def _run(self, key, fn, ready):
+        if ready is None or self.cache is None:
+            return await fn()
+
+        lock = self.cache.lock(key, timeout=self.lock_timeout, blocking_timeout=self.wait_timeout)
+        acquired = await lock.acquire()
+        try:
+            if acquired:
+                # another worker may have filled the cache while we waited for the lock
+                result = await ready()
+                if result is not None:
+                    return result
+            else:
+                logging.warning(f"Timed out waiting for lock on {key}, computing anyway")
+            return await fn()
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except LockError:
+                    logging.warning(f"Lock on {key} expired before release")
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import math
+
+# magnitudes below this are counted as zero
+MIN_INDEXABLE = 1e-9
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with a relative accuracy guarantee (DDSketch). Values are counted in
+    logarithmic buckets, so any quantile is returned within `relative_accuracy` of the true value,
+    and two sketches of the same accuracy merge by adding bucket counts. Moments are kept alongside
+    for count/min/max/mean/skew.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # bucket counts as (offset, counts) for positive values and for magnitudes of negative values
+        self.positive = (0, np.zeros(0, dtype=np.int64))
+        self.negative = (0, np.zeros(0, dtype=np.int64))
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        # power sums of (x - shift), shifted to the first value seen to avoid cancellation
+        self.shift = None
+        self.sums = np.zeros(3)
+
+    @classmethod
+    def from_values(cls, values, relative_accuracy: float = 0.01):
+        sketch = cls(relative_accuracy)
+        sketch.add(values)
+        return sketch
+
+    def _index(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def _bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    @staticmethod
+    def _add_counts(store, indexes, counts=None):
+        offset, current = store
+        if len(indexes) == 0:
+            return store
+        low = min(indexes.min(), offset) if len(current) else indexes.min()
+        high = max(indexes.max(), offset + len(current) - 1) if len(current) else indexes.max()
+        merged = np.zeros(high - low + 1, dtype=np.int64)
+        merged[offset - low:offset - low + len(current)] += current
+        np.add.at(merged, indexes - low, 1 if counts is None else counts)
+        return low, merged
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        positive = values[values > MIN_INDEXABLE]
+        negative = -values[values < -MIN_INDEXABLE]
+        self.positive = self._add_counts(self.positive, self._index(positive))
+        self.negative = self._add_counts(self.negative, self._index(negative))
+        self.zero_count += len(values) - len(positive) - len(negative)
+
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        if self.shift is None:
+            self.shift = float(values[0])
+        shifted = values - self.shift
+        self.sums += [shifted.sum(), np.square(shifted).sum(), np.power(shifted, 3).sum()]
+
+    def _shifted_sums(self, shift):
+        """Power sums of (x - shift) derived from the stored ones."""
+        if self.shift is None:
+            return np.zeros(3)
+        c = self.shift - shift
+        n = self.count
+        s1, s2, s3 = self.sums
+        return np.array([
+            s1 + n * c,
+            s2 + 2 * c * s1 + n * c ** 2,
+            s3 + 3 * c * s2 + 3 * c ** 2 * s1 + n * c ** 3,
+        ])
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for name in ('positive', 'negative'):
+            offset, counts = getattr(other, name)
+            indexes = np.arange(offset, offset + len(counts))
+            setattr(self, name, self._add_counts(getattr(self, name), indexes[counts > 0], counts[counts > 0]))
+        if self.shift is None:
+            self.shift = other.shift
+        self.sums += other._shifted_sums(self.shift)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+
+        # walk buckets in value order: negatives from the largest magnitude, zeros, positives
+        offset, counts = self.negative
+        cumulative = np.cumsum(counts[::-1])
+        if len(cumulative) and cumulative[-1] > rank:
+            i = int(np.searchsorted(cumulative, rank, side='right'))
+            return self._clamp(-self._bucket_value(offset + len(counts) - 1 - i))
+        seen = cumulative[-1] if len(cumulative) else 0
+
+        seen += self.zero_count
+        if seen > rank:
+            return self._clamp(0.0)
+
+        offset, counts = self.positive
+        cumulative = seen + np.cumsum(counts)
+        i = int(np.searchsorted(cumulative, rank, side='right'))
+        return self._clamp(self._bucket_value(offset + min(i, len(counts) - 1)))
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def mean(self) -> float:
+        return self.shift + self.sums[0] / self.count if self.count else math.nan
+
+    def skew(self) -> float:
+        """Bias-corrected sample skewness, same definition as pandas Series.skew."""
+        n = self.count
+        if n < 3:
+            return math.nan
+        s1, s2, s3 = self.sums
+        mean = s1 / n  # of the shifted values, central moments do not depend on the shift
+        m2 = s2 / n - mean ** 2
+        m3 = s3 / n - 3 * mean * s2 / n + 2 * mean ** 3
+        if m2 <= 0:
+            return 0.0
+        return m3 / m2 ** 1.5 * math.sqrt(n * (n - 1)) / (n - 2)
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'positive': [int(self.positive[0]), self.positive[1].tolist()],
+            'negative': [int(self.negative[0]), self.negative[1].tolist()],
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'shift': self.shift,
+            'sums': self.sums.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'])
+        sketch.positive = (data['positive'][0], np.asarray(data['positive'][1], dtype=np.int64))
+        sketch.negative = (data['negative'][0], np.asarray(data['negative'][1], dtype=np.int64))
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch.shift = data['shift']
+        sketch.sums = np.asarray(data['sums'], dtype=float)
+        return sketch
+
+
+def build_sketches(df: pd.DataFrame, relative_accuracy: float = 0.01, skip=('timestamp',)):
+    """One sketch per numeric column."""
+    return {
+        col: QuantileSketch.from_values(df[col].to_numpy(), relative_accuracy)
+        for col in df.columns
+        if col not in skip and pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])
+    }
+
+
+def sketches_to_json(sketches) -> dict:
+    return {col: sketch.to_dict() for col, sketch in sketches.items()}
+
+
+def sketches_from_json(data) -> dict:
+    return {col: QuantileSketch.from_dict(sketch) for col, sketch in data.items()}
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filter import DataFilter, iqr_mask, sketch_quartiles
+from sketch import QuantileSketch
+
+
+def iqr_positions(values, sketch):
+    positions, _ = DataFilter({"v": values}, "", "", {"iqr": True}, "v", sketch=sketch).select()
+    return positions
+
+
+def test_offset_column_matches_exact_mask():
+    rng = np.random.default_rng(0)
+    lat = 37.5 + rng.normal(0, 1e-3, 100_000)
+    sketch = QuantileSketch.from_values(lat, 0.01)
+
+    assert sketch_quartiles(sketch) is None
+    np.testing.assert_array_equal(iqr_positions(lat, sketch), np.flatnonzero(iqr_mask(lat)))
+
+
+def test_centered_column_uses_sketch_close_to_exact():
+    rng = np.random.default_rng(1)
+    x = rng.normal(0, 1, 100_000) + 5 * (rng.random(100_000) < 0.01)
+    sketch = QuantileSketch.from_values(x, 0.001)
+
+    assert sketch_quartiles(sketch) is not None
+    sketch_mask = np.zeros(len(x), dtype=bool)
+    sketch_mask[iqr_positions(x, sketch)] = True
+    assert np.mean(sketch_mask != iqr_mask(x)) < 1e-3
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from scipy.ndimage import gaussian_filter1d
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filter import ROW_COLUMN, apply_filter_layer, moving_average_mask
+from filter_stack import apply_step
+
+CHUNK_SIZES = [1, 3, 7, 64, 1000, 5000]
+
+STEPS = [
+    {"header": "x", "selectedFilter": "", "inputValue": "", "checkboxes": {"movingAvg": True}},
+    {"header": "x", "selectedFilter": "", "inputValue": "", "checkboxes": {"gaussian": True}},
+    {"header": "x", "selectedFilter": ">", "inputValue": "-2",
+     "checkboxes": {"iqr": True, "movingAvg": True, "gaussian": True}},
+]
+
+
+def make_frame(rows=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(0, 1, rows)
+    x[rng.choice(rows, 30, replace=False)] *= 20
+    return pd.DataFrame({"x": x, "y": rng.normal(0, 1, rows)})
+
+
+def batch_reader(df, chunk_size):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    def read(columns):
+        for start in range(0, table.num_rows, chunk_size):
+            yield table.select(columns).slice(start, chunk_size)
+    return read
+
+
+def in_memory(df, steps):
+    # the whole-column reference: each step on the full filtered frame
+    for step in steps:
+        values = df[step["header"]].to_numpy()
+        if step["inputValue"]:
+            df = df[values > float(step["inputValue"])]
+            values = df[step["header"]].to_numpy()
+        checkboxes = step["checkboxes"]
+        if checkboxes.get("iqr"):
+            q1, q3 = np.nanquantile(values, [0.25, 0.75])
+            df = df[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+            values = df[step["header"]].to_numpy()
+        if checkboxes.get("movingAvg"):
+            df = df[moving_average_mask(values)]
+            values = df[step["header"]].to_numpy()
+        if checkboxes.get("gaussian"):
+            df = df.assign(**{step["header"]: gaussian_filter1d(values, sigma=1.0)})
+    return df
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("step", STEPS)
+def test_streamed_step_matches_in_memory(step, chunk_size):
+    df = make_frame()
+    layer = apply_step(batch_reader(df, chunk_size), list(df.columns), None, step)
+
+    expected = in_memory(df, [step])
+    np.testing.assert_array_equal(layer[ROW_COLUMN].to_numpy(), expected.index.to_numpy())
+    pd.testing.assert_frame_equal(apply_filter_layer(df, layer), expected)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_streamed_stack_matches_in_memory(chunk_size):
+    df = make_frame(seed=1)
+    steps = STEPS + [{"expression": "abs(x) < 1 and y > -1"}]
+    read = batch_reader(df, chunk_size)
+    layer = None
+    for step in steps:
+        layer = apply_step(read, list(df.columns), layer, step)
+
+    expected = in_memory(df, STEPS)
+    expected = expected[(expected.x.abs() < 1) & (expected.y > -1)]
+    pd.testing.assert_frame_equal(apply_filter_layer(df, layer), expected)